@@ -1,9 +1,20 @@
 import sys
 import os
+import argparse
+import glob
+import multiprocessing
+import time
 from enum import Enum
 from tempfile import TemporaryFile
+from array import array
 import re
-import ctypes
+import struct
+import functools
+import hashlib
+import itertools
+import contextlib
+import json
+import tracemalloc
 
 ################################################
 # For debug option. If you want to debug, set 1
@@ -12,11 +23,47 @@ import ctypes
 
 DEBUG = 0
 
-MAX_SYMBOL_TABLE_SIZE = 1024
+# part of every cache key, bump it whenever the encoding of any
+# instruction, the object layout or the way a source is read changes
+ASSEMBLER_VERSION = '1.4'
+
 MEM_TEXT_START = 0x00400000
 MEM_DATA_START = 0x10000000
 BYTES_PER_WORD = 4
 
+# a section buffer moves its words to a temporary file once it holds
+# this many of them (16MB), 0 keeps everything in memory
+SECTION_SPILL_WORDS = 1 << 22
+
+# packed binary object: magic, text size, data size (big-endian),
+# then the text and data words as big-endian 32-bit words
+OBJ_MAGIC = b'MIPO'
+OBJ_HEADER = struct.Struct('>4sII')
+OUTPUT_FORMATS = ('text', 'bin', 'rel')
+
+# relocatable object: magic, text size, data size, symbol count and
+# relocation count, the words as in the packed object, then the symbol
+# and relocation records, each followed by its name in UTF-8
+REL_MAGIC = b'MIPR'
+REL_HEADER = struct.Struct('>4sIIII')
+# section ('T' / 'D'), offset in that section, name length
+REL_SYMBOL = struct.Struct('>cIH')
+# relocation type, text offset of the word, addend, name length
+REL_ENTRY = struct.Struct('>BIiH')
+
+# object output: words formatted per write() call, and the buffer size
+# of the output file
+WRITE_CHUNK_WORDS = 1 << 14
+WRITE_BUFFER_BYTES = 1 << 20
+
+# parallel encoding: words per chunk sent to a worker, and the text size
+# below which the pool costs more than it saves
+PARALLEL_CHUNK_WORDS = 1 << 14
+PARALLEL_MIN_WORDS = 1 << 16
+
+# default size bound of the assembly cache
+CACHE_MAX_BYTES = 256 << 20
+
 ################################################
 # Additional Components
 ################################################
@@ -37,8 +84,38 @@ error = '[' + bcolors.RED + 'ERROR' + bcolors.ENDC + ']  '
 pType = [start, done, success, error]
 
 
-def log(printType, content):
-    print(pType[printType] + content)
+# verbosity a message needs before it is printed: errors and results
+# always, progress with -v, per-symbol and per-word dumps with -vv
+LOG_ALWAYS = 0
+LOG_VERBOSE = 1
+LOG_DEBUG = 2
+
+# default level of each printType: start / done are progress messages
+pLevel = [LOG_VERBOSE, LOG_VERBOSE, LOG_ALWAYS, LOG_ALWAYS]
+
+verbosity = LOG_DEBUG if DEBUG else LOG_ALWAYS
+
+# where log() prints, None is stdout. Moved to stderr when the object
+# itself is written to stdout
+log_stream = None
+
+
+def set_verbosity(level):
+    global verbosity, DEBUG
+    verbosity = level
+    DEBUG = 1 if level >= LOG_DEBUG else 0
+
+
+# content is only %-formatted with args once the message is printed,
+# hot loops additionally check DEBUG before calling log at all
+def log(printType, content, *args, level=None):
+    if level is None:
+        level = pLevel[printType]
+    if level > verbosity:
+        return
+    if args:
+        content = content % args
+    print(pType[printType] + content, file=log_stream)
 
 
 ################################################
@@ -59,12 +136,113 @@ class symbol_t:
         self.address = 0
 
 
+class asm_error(Exception):
+    pass
+
+
+class symbol_table_t:
+    # label name -> symbol_t. dicts keep insertion order, so iterating
+    # the table walks the labels in the order they were defined
+    def __init__(self):
+        self.symbols = {}
+        self.lookups = 0
+
+    def add_entry(self, symbol):
+        if symbol.name in self.symbols:
+            prev = self.symbols[symbol.name]
+            raise asm_error(f"Duplicate label {symbol.name} "
+                            f"(already defined at 0x{prev.address:08x})")
+
+        self.symbols[symbol.name] = symbol
+        if DEBUG:
+            log(1, "%s: 0x%08x", symbol.name, symbol.address)
+
+    def convert_label(self, label):
+        self.lookups += 1
+        symbol = self.symbols.get(label)
+        if symbol is None:
+            raise asm_error(f"Undefined label {label}")
+        return symbol.address
+
+    def __contains__(self, label):
+        return label in self.symbols
+
+    def __iter__(self):
+        return iter(self.symbols.values())
+
+    def __len__(self):
+        return len(self.symbols)
+
+
 class la_struct:
     def __init__(self, op, rt, imm):
         self.op = op
         self.rt = rt
         self.imm = imm
 
+class section_buffer_t:
+    # words of one section, kept in a compact array('I'). Past
+    # spill_words the words are appended to a binary temporary file
+    # and the in-memory array starts over.
+    def __init__(self, spill_words=SECTION_SPILL_WORDS):
+        self.words = array('I')
+        self.spill_words = spill_words
+        self.spill = None
+        self.spilled = 0
+
+    def append(self, word):
+        self.words.append(word & 0xffffffff)
+        if self.spill_words and len(self.words) >= self.spill_words:
+            self.flush_to_disk()
+
+    def flush_to_disk(self):
+        if self.spill is None:
+            self.spill = TemporaryFile('w+b')
+        self.spill.seek(0, os.SEEK_END)
+        self.words.tofile(self.spill)
+        self.spilled += len(self.words)
+        self.words = array('I')
+
+    def __len__(self):
+        return self.spilled + len(self.words)
+
+    # overwrite the word at index, in memory or in the spill file
+    def patch(self, index, word):
+        word &= 0xffffffff
+        if index >= self.spilled:
+            self.words[index - self.spilled] = word
+            return
+        self.spill.seek(index * self.words.itemsize)
+        array('I', [word]).tofile(self.spill)
+
+    # words have to be unsigned 32-bit values already
+    def extend(self, words):
+        self.words.extend(words)
+        if self.spill_words and len(self.words) >= self.spill_words:
+            self.flush_to_disk()
+
+    # the words as a sequence of array('I') chunks, in order
+    def chunks(self):
+        if self.spill is not None:
+            self.spill.seek(0)
+            left = self.spilled
+            while left > 0:
+                chunk = array('I')
+                chunk.fromfile(self.spill, min(left, self.spill_words))
+                left -= len(chunk)
+                yield chunk
+        yield self.words
+
+    def __iter__(self):
+        for chunk in self.chunks():
+            yield from chunk
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+
+
 class section(Enum):
     DATA = 0
     TEXT = 1
@@ -108,14 +286,6 @@ inst_list = [ADD,  ADDI, ADDIU, ADDU, AND,
              SLTU, SLL,  SRL,   SW, 
              SUB,  SUBU, ]
 
-symbol_struct = symbol_t()
-SYMBOL_TABLE = [symbol_struct] * MAX_SYMBOL_TABLE_SIZE
-
-symbol_table_cur_index = 0
-
-data_section_size = 0
-text_section_size = 0
-
 
 ################################################
 # Function Declaration
@@ -128,82 +298,509 @@ def change_file_ext(fin_name):
     return fout_name
 
 
-def symbol_table_add_entry(symbol):
-    global SYMBOL_TABLE
-    global symbol_table_cur_index
+# kept for compatibility, the encoders work on ints and only
+# format_word turns a finished word into its '0'/'1' form
+def num_to_bits(num, len):
+    return format(num & ((1 << len) - 1), '0%db' % len)
 
-    SYMBOL_TABLE[symbol_table_cur_index] = symbol
-    symbol_table_cur_index += 1
-    if DEBUG:
-        log(1, f"{symbol.name}: 0x" + hex(symbol.address)[2:].zfill(8))
 
+def format_word(word):
+    return format(word & 0xffffffff, '032b')
 
-def convert_label(label):
-    address = 0
-    for i in range(symbol_table_cur_index):
-        if label == SYMBOL_TABLE[i].name:
-            address = SYMBOL_TABLE[i].address
-            break
-    return address
+# 0x / 0o / 0b prefixes in either case; a decimal with leading
+# zeros (010) stays decimal
+def parse_imm(imm):
+    try:
+        return int(imm, 0)
+    except ValueError:
+        return int(imm, 10)
 
 
-def num_to_bits(num, len):
-    bit = bin(num & (2**len-1))[2:].zfill(len)
-    return bit
-
-def convert_mips_to_binary(line):
-    tokens = line.strip('\n\t').split()
-    for i in range(len(tokens)):
-        tokens[i] = tokens[i].strip(',')
-    for i in inst_list:
-        if i.name == tokens[0]:
-            word = i.op
-            address = 0
-            # write the SLL, SRL, JR and etc that R format and complex
-            if i.type == 'R':
-                print(tokens)
-                # pass the str if needed
-                rd, rs, rt = tokens[1], tokens[2], tokens[3]
-                word = word + num_to_bits(int(rs.strip('$')), 5)
-                word = word + num_to_bits(int(rt.strip('$')), 5)
-                word = word + num_to_bits(int(rd.strip('$')), 5)
-                word = word + num_to_bits(0, 5)
-                if i.funct == "":
-                    word = word + num_to_bits(0, 6)
-                else:
-                    word = word + i.funct
-            elif i.type == 'I':
-                if i.name == 'lw' or i.name == 'sw':
-                    rt, offset, rs = tokens[1], tokens[2], tokens[3]
-                    word = word + num_to_bits(int(rs.strip('$')), 5)
-                    word = word + num_to_bits(int(rt.strip('$')), 5)
-                    word = word + num_to_bits(int(offset.split('(')[0]), 16)  
-                    if 'x' in offset: 
-                        offset_value = int(offset, 16)
-                    else:
-                        offset_value = int(offset)
-                    word = word + num_to_bits(offset_value, 16)
-                elif i.name == 'beq' or i.name == 'bne':
-                    rs, rt, label = tokens[1], tokens[2], tokens[3]
-                    word = word + num_to_bits(int(rs.strip('$')), 5)
-                    word = word + num_to_bits(int(rt.strip('$')), 5)
-                    word = word + num_to_bits(convert_label(label) - address - 1, 16)  
-                elif i.name == 'addi' or i.name == 'ori' or i.name == 'slti' or i.name == 'lui' or i.name == 'addiu':
-                    rt, rs, imm = tokens[1], tokens[2], tokens[3]
-                    word = word + num_to_bits(int(rs.strip('$')), 5)
-                    word = word + num_to_bits(int(rt.strip('$')), 5)
-                    if 'x' in imm:
-                        imm_value = int(imm, 16)
-                    else:
-                        imm_value = int(imm)
-                    word = word + num_to_bits(imm_value, 16)
-            elif i.type == 'J':
-                label = tokens[1] 
-                opcode = i.op
-                address = convert_label(label) // 4
-                address_bits = bin(address)[2:].zfill(26)
-                word = opcode + address_bits
-            return word
+################################################
+# Lexer
+#
+# One compiled regular expression splits a line
+# into tokens in a single scan, each token is
+# typed by its first character. Operands come
+# out as (kind, value) pairs:
+#   (OP_REG, 8)              $8, $t0
+#   (OP_IMM, -4)             -4, 0x3f
+#   (OP_LABEL, 'main')       main
+#   (OP_MEM, (-4, 3))        -4($3)
+#   (OP_HI / OP_LO, 'main')  %hi(main), %lo(main)
+################################################
+
+OP_REG = 'reg'
+OP_IMM = 'imm'
+OP_LABEL = 'label'
+OP_MEM = 'mem'
+OP_HI = 'hi'
+OP_LO = 'lo'
+
+REGISTER_NAMES = {str(i): i for i in range(32)}
+REGISTER_NAMES.update({
+    'zero': 0, 'at': 1, 'v0': 2, 'v1': 3,
+    'a0': 4, 'a1': 5, 'a2': 6, 'a3': 7,
+    't0': 8, 't1': 9, 't2': 10, 't3': 11,
+    't4': 12, 't5': 13, 't6': 14, 't7': 15,
+    's0': 16, 's1': 17, 's2': 18, 's3': 19,
+    's4': 20, 's5': 21, 's6': 22, 's7': 23,
+    't8': 24, 't9': 25, 'k0': 26, 'k1': 27,
+    'gp': 28, 'sp': 29, 'fp': 30, 'ra': 31,
+})
+
+# one match per token: offset(base) or %hi(label), a comment start,
+# or any other run of characters up to the next separator
+TOKEN_RE = re.compile(r'[^\s,#()]*\(\s*[^\s,#()]*\s*\)|#|[^\s,#]+')
+
+IDENT_RE = re.compile(r'[A-Za-z_.][\w.$]*$')
+MEM_RE = re.compile(r'([-+]?\d\w*)?\(\s*\$(\w+)\s*\)$')
+HALF_RE = re.compile(r'%(hi|lo)\(\s*([A-Za-z_.][\w.$]*)\s*\)$')
+
+# '$t0' -> (OP_REG, 8), shared by every operand naming that register
+REG_OPERANDS = {'$' + name: (OP_REG, reg) for name, reg in REGISTER_NAMES.items()}
+
+
+def lex_reg(name):
+    reg = REGISTER_NAMES.get(name)
+    if reg is None:
+        raise asm_error(f"Unknown register ${name}")
+    return reg
+
+
+def lex_operand(tok):
+    c = tok[0]
+    if c == '$':
+        op = REG_OPERANDS.get(tok)
+        if op is None:
+            raise asm_error(f"Unknown register {tok}")
+        return op
+    if tok[-1] == ')':
+        m = MEM_RE.match(tok)
+        if m is not None:
+            try:
+                offset = parse_imm(m.group(1) or '0')
+            except ValueError:
+                raise asm_error(f"Invalid operand {tok!r}") from None
+            return OP_MEM, (offset, lex_reg(m.group(2)))
+        m = HALF_RE.match(tok)
+        if m is not None:
+            return (OP_HI if m.group(1) == 'hi' else OP_LO), m.group(2)
+    elif c in '-+0123456789':
+        try:
+            return OP_IMM, parse_imm(tok)
+        except ValueError:
+            pass
+    elif IDENT_RE.match(tok):
+        return OP_LABEL, tok
+    raise asm_error(f"Invalid operand {tok!r}")
+
+
+# operand text -> (kind, value). Source files repeat the same registers,
+# immediates and labels, so most operands are typed only once; a miss
+# goes to lex_operand and is kept while there is room
+class operand_cache_t(dict):
+    def __missing__(self, tok):
+        op = lex_operand(tok)
+        if len(self) < OPERAND_CACHE_SIZE:
+            self[tok] = op
+        return op
+
+
+OPERAND_CACHE_SIZE = 1 << 14
+lex_operands = operand_cache_t(REG_OPERANDS).__getitem__
+
+
+# (labels, mnemonic, operands) of one source line. A blank or comment
+# line has no labels and a None mnemonic
+def lex_line(line):
+    if '(' in line or '#' in line:
+        toks = TOKEN_RE.findall(line)
+        if '#' in toks:
+            toks = toks[:toks.index('#')]
+    else:
+        # without parentheses or a comment these are the tokens
+        # TOKEN_RE finds, at a fraction of the cost
+        toks = line.replace(',', ' ').split()
+    labels = []
+    for i, tok in enumerate(toks):
+        if tok[-1] != ':':
+            # checked against the instruction and directive tables later
+            return labels, tok, tuple(map(lex_operands, toks[i + 1:]))
+        if not IDENT_RE.match(tok[:-1]):
+            raise asm_error(f"Invalid label {tok!r}")
+        labels.append(tok[:-1])
+    return labels, None, ()
+
+
+# (labels, directive, values) of a data line like 'tbl: .word 1, -2, 0x3'
+# without typing every token, None if the line needs lex_line (other
+# directives, non-numeric values, errors to report)
+def lex_data_line(line):
+    toks = line.split('#', 1)[0].replace(',', ' ').split()
+    i = 0
+    while i < len(toks) and toks[i][-1] == ':':
+        i += 1
+    if i == len(toks) or toks[i] not in DATA_DIRECTIVES:
+        return None
+    labels = [tok[:-1] for tok in toks[:i]]
+    for label in labels:
+        if not IDENT_RE.match(label):
+            return None
+    try:
+        values = [parse_imm(tok) for tok in toks[i + 1:]]
+    except ValueError:
+        return None
+    return labels, toks[i], values
+
+
+def format_operand(op):
+    kind, value = op
+    if kind == OP_REG:
+        return f"${value}"
+    if kind == OP_MEM:
+        return f"{value[0]}(${value[1]})"
+    if kind in (OP_HI, OP_LO):
+        return f"%{kind}({value})"
+    return str(value)
+
+
+def op_reg(op):
+    if op[0] != OP_REG:
+        raise asm_error(f"Expected a register, got {format_operand(op)}")
+    return op[1]
+
+
+def op_imm(op, symbols):
+    kind, value = op
+    if kind == OP_IMM:
+        return value
+    if kind == OP_HI:
+        return symbols.convert_label(value) >> 16
+    if kind == OP_LO:
+        return symbols.convert_label(value) & 0xffff
+    raise asm_error(f"Expected an immediate, got {format_operand(op)}")
+
+
+# branch / jump target: a label, or an absolute address
+def op_address(op, symbols):
+    kind, value = op
+    if kind == OP_LABEL:
+        return symbols.convert_label(value)
+    if kind == OP_IMM:
+        return value & 0xffffffff
+    raise asm_error(f"Expected a label, got {format_operand(op)}")
+
+
+def op_mem(op):
+    if op[0] != OP_MEM:
+        raise asm_error(f"Expected offset($base), got {format_operand(op)}")
+    return op[1]
+
+
+################################################
+# Instruction Encoders
+#
+# Every encoder takes the instruction template
+# (opcode and funct already in place), the
+# typed operands, the address of the
+# instruction and the symbol table, and
+# returns the 32-bit word as an int.
+################################################
+
+def encode_r_type(template, operands, address, symbols):
+    rd, rs, rt = operands
+    return template | op_reg(rs) << 21 | op_reg(rt) << 16 | op_reg(rd) << 11
+
+
+def encode_shift(template, operands, address, symbols):
+    rd, rt, shamt = operands
+    return (template | op_reg(rt) << 16 | op_reg(rd) << 11
+            | (op_imm(shamt, symbols) & 0x1f) << 6)
+
+
+def encode_jr(template, operands, address, symbols):
+    rs, = operands
+    return template | op_reg(rs) << 21
+
+
+def encode_i_type(template, operands, address, symbols):
+    rt, rs, imm = operands
+    return (template | op_reg(rs) << 21 | op_reg(rt) << 16
+            | op_imm(imm, symbols) & 0xffff)
+
+
+def encode_lui(template, operands, address, symbols):
+    rt, imm = operands
+    return template | op_reg(rt) << 16 | op_imm(imm, symbols) & 0xffff
+
+
+def encode_mem(template, operands, address, symbols):
+    rt, mem = operands
+    offset, rs = op_mem(mem)
+    return template | rs << 21 | op_reg(rt) << 16 | offset & 0xffff
+
+
+def encode_branch(template, operands, address, symbols):
+    rs, rt, label = operands
+    offset = (op_address(label, symbols) - address - BYTES_PER_WORD) >> 2
+    return template | op_reg(rs) << 21 | op_reg(rt) << 16 | offset & 0xffff
+
+
+def encode_j_type(template, operands, address, symbols):
+    label, = operands
+    return template | (op_address(label, symbols) >> 2) & 0x3ffffff
+
+
+# a raw word in .text, e.g. one the disassembler could not decode
+def encode_word(template, operands, address, symbols):
+    value, = operands
+    return op_imm(value, symbols) & 0xffffffff
+
+
+TYPE_ENCODERS = {'R': encode_r_type, 'I': encode_i_type, 'J': encode_j_type}
+
+# instructions whose operand layout differs from the default of their type
+ENCODER_OVERRIDES = {
+    'sll': encode_shift,
+    'srl': encode_shift,
+    'jr': encode_jr,
+    'lui': encode_lui,
+    'lw': encode_mem,
+    'sw': encode_mem,
+    'beq': encode_branch,
+    'bne': encode_branch,
+}
+
+
+def inst_template(inst):
+    return int(inst.op, 2) << 26 | int(inst.funct or '0', 2)
+
+
+# mnemonic -> (encoder, template), built once at import time
+INST_DISPATCH = {
+    i.name: (ENCODER_OVERRIDES.get(i.name, TYPE_ENCODERS[i.type]),
+             inst_template(i))
+    for i in inst_list
+}
+INST_DISPATCH['.word'] = (encode_word, 0)
+
+
+def encode_tokens(name, operands, address, symbols):
+    entry = INST_DISPATCH.get(name)
+    if entry is None:
+        raise asm_error(f"Unknown instruction {name}")
+    encode, template = entry
+    try:
+        return encode(template, operands, address, symbols)
+    except ValueError:
+        raise asm_error(f"Invalid operands: {name} "
+                        f"{', '.join(map(format_operand, operands))}")
+
+
+# encode_tokens for a text_ir entry (address, name, operands, line),
+# errors name the source line the instruction came from
+def encode_ir(entry, symbols):
+    address, name, operands, lineno = entry
+    try:
+        return encode_tokens(name, operands, address, symbols)
+    except asm_error as e:
+        raise asm_error(f"line {lineno}: {e}") from None
+
+
+################################################
+# Disassembler
+#
+# The inverse of INST_DISPATCH. DECODE_INDEX maps
+# (opcode, funct) to the position of the inst_t
+# in inst_list, funct only counts for opcode 0.
+# Each decoder turns the fields of a word back
+# into operand text that lex_line reads again.
+################################################
+
+def sign16(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def decode_r_type(word, address, labels):
+    return "$%d, $%d, $%d" % (word >> 11 & 0x1f, word >> 21 & 0x1f,
+                              word >> 16 & 0x1f)
+
+
+def decode_shift(word, address, labels):
+    return "$%d, $%d, %d" % (word >> 11 & 0x1f, word >> 16 & 0x1f,
+                             word >> 6 & 0x1f)
+
+
+def decode_jr(word, address, labels):
+    return "$%d" % (word >> 21 & 0x1f)
+
+
+def decode_i_type(word, address, labels):
+    return "$%d, $%d, %d" % (word >> 16 & 0x1f, word >> 21 & 0x1f,
+                             sign16(word & 0xffff))
+
+
+# andi / ori zero-extend their immediate
+def decode_logic_imm(word, address, labels):
+    return "$%d, $%d, 0x%x" % (word >> 16 & 0x1f, word >> 21 & 0x1f,
+                               word & 0xffff)
+
+
+def decode_lui(word, address, labels):
+    return "$%d, 0x%x" % (word >> 16 & 0x1f, word & 0xffff)
+
+
+def decode_mem(word, address, labels):
+    return "$%d, %d($%d)" % (word >> 16 & 0x1f, sign16(word & 0xffff),
+                             word >> 21 & 0x1f)
+
+
+def decode_branch(word, address, labels):
+    target = address + BYTES_PER_WORD + (sign16(word & 0xffff) << 2)
+    return "$%d, $%d, %s" % (word >> 21 & 0x1f, word >> 16 & 0x1f,
+                             target_name(target, labels))
+
+
+def decode_j_type(word, address, labels):
+    return target_name(jump_target(word, address), labels)
+
+
+def target_name(address, labels):
+    return labels.get(address) or "0x%08x" % address
+
+
+# address a branch or jump word goes to, None for other instructions
+def jump_target(word, address):
+    op = word >> 26
+    if op == 2 or op == 3:
+        return (address & 0xf0000000) | (word & 0x3ffffff) << 2
+    if op == 4 or op == 5:
+        return address + BYTES_PER_WORD + (sign16(word & 0xffff) << 2)
+    return None
+
+
+TYPE_DECODERS = {'R': decode_r_type, 'I': decode_i_type, 'J': decode_j_type}
+
+DECODER_OVERRIDES = {
+    'sll': decode_shift,
+    'srl': decode_shift,
+    'jr': decode_jr,
+    'andi': decode_logic_imm,
+    'ori': decode_logic_imm,
+    'lui': decode_lui,
+    'lw': decode_mem,
+    'sw': decode_mem,
+    'beq': decode_branch,
+    'bne': decode_branch,
+}
+
+
+def decode_key(inst):
+    op = int(inst.op, 2)
+    return op, int(inst.funct or '0', 2) if op == 0 else 0
+
+
+# (opcode, funct) -> index into inst_list, built once at import time
+DECODE_INDEX = {decode_key(i): n for n, i in enumerate(inst_list)}
+DECODERS = [DECODER_OVERRIDES.get(i.name, TYPE_DECODERS[i.type])
+            for i in inst_list]
+
+
+# (mnemonic, operand text) of one word, None if no inst_t matches.
+# labels maps addresses to the names used for branch / jump targets
+def decode_word(word, address=MEM_TEXT_START, labels={}):
+    op = word >> 26
+    index = DECODE_INDEX.get((op, word & 0x3f if op == 0 else 0))
+    if index is None:
+        return None
+    return inst_list[index].name, DECODERS[index](word, address, labels)
+
+
+# address -> name of every symbol, plus L_<address> for the branch and
+# jump targets inside the text section that have none
+def disassembly_labels(text_words, symbols=None, start=MEM_TEXT_START):
+    labels = {}
+    if symbols is not None:
+        for symbol in symbols:
+            labels.setdefault(symbol.address, symbol.name)
+    end = start + BYTES_PER_WORD * len(text_words)
+    address = start
+    for word in text_words:
+        target = jump_target(word, address)
+        if target is not None and start <= target <= end and target not in labels:
+            labels[target] = 'L_%08x' % target
+        address += BYTES_PER_WORD
+    return labels
+
+
+# source lines for the text words, each annotated with its address
+# and encoding. Words that are no instruction come out as .word
+def disassemble(text_words, labels, start=MEM_TEXT_START):
+    address = start
+    # register and upper half of the last lui, to name la's target
+    hi_reg = hi = None
+    for word in text_words:
+        name = labels.get(address)
+        if name is not None:
+            yield name + ':'
+        decoded = decode_word(word, address, labels)
+        if decoded is None:
+            yield "\t.word\t0x%08x\t# 0x%08x: unknown instruction" % (word, address)
+        else:
+            mnemonic, operands = decoded
+            note = ''
+            if mnemonic == 'ori' and hi is not None and word >> 21 & 0x1f == hi_reg:
+                note = labels.get(hi | (word & 0xffff))
+                note = ' ' + note if note else ''
+            hi_reg, hi = None, None
+            if mnemonic == 'lui':
+                hi_reg, hi = word >> 16 & 0x1f, (word & 0xffff) << 16
+                note = labels.get(hi)
+                note = ' ' + note if note else ''
+            yield "\t%s\t%s\t# 0x%08x: 0x%08x%s" % (mnemonic, operands, address,
+                                                  word, note)
+        address += BYTES_PER_WORD
+    name = labels.get(address)
+    if name is not None:
+        yield name + ':'
+
+
+def disassemble_data(data_words, labels, start=MEM_DATA_START):
+    end = start + BYTES_PER_WORD * len(data_words)
+    # labels that don't start a word (after .byte / .half) as comments
+    for address in sorted(a for a in labels if start <= a < end and a % BYTES_PER_WORD):
+        yield "# %s = 0x%08x" % (labels[address], address)
+    address = start
+    for word in data_words:
+        name = labels.get(address)
+        if name is not None:
+            yield name + ':'
+        yield "\t.word\t0x%08x\t# 0x%08x" % (word, address)
+        address += BYTES_PER_WORD
+    name = labels.get(address)
+    if name is not None:
+        yield name + ':'
+
+
+# the whole image as a program that assembles back to the same words
+def disassemble_image(image):
+    labels = disassembly_labels(image.text_seg, image.symbols)
+    yield "\t.data"
+    yield from disassemble_data(image.data_seg, labels)
+    yield "\t.text"
+    yield from disassemble(image.text_seg, labels)
+
+
+def encode_instruction(line, address=MEM_TEXT_START, symbols=None):
+    if symbols is None:
+        symbols = symbol_table_t()
+    labels, name, operands = lex_line(line)
+    return encode_tokens(name, operands, address, symbols)
+
+
+def convert_mips_to_binary(line, symbols=None):
+    return format_word(encode_instruction(line, symbols=symbols))
 
 #################################################
 # # # # # # # # # # # # # # # # # # # # # # # # #
@@ -215,199 +812,1560 @@ def convert_mips_to_binary(line):
 # # # # # # # # # # # # # # # # # # # # # # # # #
 #################################################
 
-def make_symbol_table(input):
-    size_bit = 0
-    address = 0
-
-    cur_section = section.MAX_SIZE.value
-
-    # Read .data section
-    lines = input.readlines()
-    while len(lines) > 0:
-        line = lines.pop(0)
-        line = line.strip()
-        _line = line
-        token_line = _line.strip('\n\t').split()
-        temp = token_line[0]
-
-        if temp == ".data":
-            '''
-            blank
-            '''
-            cur_section = section.DATA.value
-            global data_seg
-            data_seg = TemporaryFile('w+')
-            continue
+################################################
+# Data Directives
+#
+# directive -> data_directive_t: the alignment
+# of its first byte and how its values go into
+# the data section. Every value list is handled
+# in one call.
+################################################
+
+class data_directive_t:
+    def __init__(self, align, emit):
+        self.align = align
+        self.emit = emit
+
+
+def emit_halves(image, values):
+    halves = array('H', [v & 0xffff for v in values])
+    if sys.byteorder == 'little':
+        halves.byteswap()
+    image.add_data_bytes(halves.tobytes())
+
+
+def emit_space(image, values):
+    if len(values) != 1 or values[0] < 0:
+        raise asm_error(".space takes one non-negative size")
+    image.add_data_bytes(bytes(values[0]))
+
+
+DATA_DIRECTIVES = {
+    '.word':  data_directive_t(4, lambda image, values: image.add_data_words(values)),
+    '.half':  data_directive_t(2, emit_halves),
+    '.byte':  data_directive_t(1, lambda image, values:
+                               image.add_data_bytes(bytes([v & 0xff for v in values]))),
+    '.space': data_directive_t(1, emit_space),
+}
+
+
+################################################
+# Pseudo Instructions
+#
+# Each pseudo instruction maps to a tuple of
+# base instructions (name, operand, ...). An int
+# operand is an index into the pseudo
+# instruction's own operands, a callable builds
+# the operand from them, anything else is a
+# literal typed operand. The first pass
+# expands pseudo instructions straight into base
+# instructions, so their size is known without
+# encoding anything.
+################################################
+
+class pseudo_t:
+    # choose, when given, picks the templates from the operands and the
+    # labels known so far, for expansions whose size depends on a value,
+    # and checks the operands itself
+    def __init__(self, templates=(), choose=None):
+        self.templates = templates
+        self.choose = choose
+        # operands the templates refer to, all of them required
+        self.operand_count = 1 + max((op for t in templates for op in t[1:]
+                                      if isinstance(op, int)), default=-1)
+
+    def expand(self, operands, symbols):
+        templates = self.templates
+        if self.choose is not None:
+            templates = self.choose(operands, symbols)
+        elif len(operands) != self.operand_count:
+            raise asm_error(f"Expected {self.operand_count} operands, "
+                            f"got {len(operands)}")
+        return [(t[0], tuple(expand_operand(op, operands) for op in t[1:]))
+                for t in templates]
+
+
+def expand_operand(op, operands):
+    if isinstance(op, int):
+        return operands[op]
+    if callable(op):
+        return op(operands)
+    return op
+
+
+def label_half(half, index):
+    def operand(operands):
+        kind, label = operands[index]
+        if kind != OP_LABEL:
+            raise asm_error(f"Expected a label, got {format_operand(operands[index])}")
+        return half, label
+    return operand
+
+
+R0 = (OP_REG, 0)
+AT = (OP_REG, 1)
+SP = (OP_REG, 29)
+STACK_TOP = (OP_MEM, (0, 29))
+
+
+def imm(value):
+    return (OP_IMM, value)
+
+
+LA_SHORT = (('lui', 0, label_half(OP_HI, 1)),)
+LA_LONG = (('lui', 0, label_half(OP_HI, 1)), ('ori', 0, 0, label_half(OP_LO, 1)))
+
+
+# lui alone when the low half is zero. A label defined further down is
+# not known yet, it always gets both words
+def choose_la(operands, symbols):
+    if len(operands) != 2:
+        raise asm_error("la takes a register and a label")
+    kind, label = operands[1]
+    if kind == OP_LABEL and label in symbols and \
+            symbols.convert_label(label) & 0xffff == 0:
+        return LA_SHORT
+    return LA_LONG
+
+
+def choose_li(operands, symbols):
+    if len(operands) != 2 or operands[1][0] != OP_IMM:
+        raise asm_error("li takes a register and an immediate")
+    value = operands[1][1]
+    if -0x8000 <= value < 0x8000:
+        return (('addiu', 0, R0, imm(value)),)
+    if 0 <= value <= 0xffff:
+        return (('ori', 0, R0, imm(value)),)
+    hi, lo = (value >> 16) & 0xffff, value & 0xffff
+    if lo == 0:
+        return (('lui', 0, imm(hi)),)
+    return (('lui', 0, imm(hi)), ('ori', 0, 0, imm(lo)))
+
+
+PSEUDO_TABLE = {
+    'la': pseudo_t(choose=choose_la),
+    'li': pseudo_t(choose=choose_li),
+    'move': pseudo_t((('addi', 0, 1, imm(0)),)),
+    'nop': pseudo_t((('sll', R0, R0, imm(0)),)),
+    'blt': pseudo_t((('slt', AT, 0, 1), ('bne', AT, R0, 2))),
+    'bgt': pseudo_t((('slt', AT, 1, 0), ('bne', AT, R0, 2))),
+    'ble': pseudo_t((('slt', AT, 1, 0), ('beq', AT, R0, 2))),
+    'bge': pseudo_t((('slt', AT, 0, 1), ('beq', AT, R0, 2))),
+    'push': pseudo_t((('addi', SP, SP, imm(-4)), ('sw', 0, STACK_TOP))),
+    'pop': pseudo_t((('lw', 0, STACK_TOP), ('addi', SP, SP, imm(4)))),
+}
+
+
+################################################
+# Object Image
+#
+# Everything one assembly run produces: the
+# symbol table, the section sizes and the
+# encoded words of both sections.
+################################################
 
-        if temp == '.text':
-            '''
-            blank
-            '''
-            cur_section = section.TEXT.value
-            global text_seg
-            text_seg = TemporaryFile('w+')
+class ObjectImage:
+    def __init__(self, spill_words=SECTION_SPILL_WORDS):
+        # profile_t of the run that made this image, if any
+        self.profile = None
+        self.symbols = symbol_table_t()
+        self.data_seg = section_buffer_t(spill_words)
+        self.text_seg = section_buffer_t(spill_words)
+        self.data_section_size = 0
+        self.text_section_size = 0
+        # bytes of .byte / .half / .space data that don't fill a word yet
+        self.data_tail = bytearray()
+        # (line number, source line, section, section offset) of every
+        # source line, only when a listing was asked for
+        self.listing = None
+        # names given to .globl, exported by a relocatable object
+        self.globals = set()
+        # (text offset, type, symbol or section, addend) of every word the
+        # linker has to patch, only for relocatable runs
+        self.relocs = None
+
+    def add_label(self, name, address):
+        symbol = symbol_t()
+        symbol.name = name
+        symbol.address = address
+        self.symbols.add_entry(symbol)
+
+    ################################################
+    # Data section
+    #
+    # data_section_size counts bytes. Whole words go
+    # to data_seg in bulk, a partial last word waits
+    # in data_tail until it is filled or padded.
+    ################################################
+
+    def add_data_words(self, values):
+        self.align_data(BYTES_PER_WORD)
+        self.data_seg.extend(array('I', [v & 0xffffffff for v in values]))
+        self.data_section_size += BYTES_PER_WORD * len(values)
+
+    # data is big-endian bytes
+    def add_data_bytes(self, data):
+        tail = self.data_tail
+        tail += data
+        self.data_section_size += len(data)
+        full = len(tail) - len(tail) % BYTES_PER_WORD
+        if full:
+            self.data_seg.extend(unpack_words(tail[:full]))
+            del tail[:full]
+
+    def align_data(self, size):
+        pad = -self.data_section_size % size
+        if pad:
+            self.add_data_bytes(bytes(pad))
+
+    #create mips instructions: la, move, blt, push, pop and else
+    def record_text_section(self, fout):
+        # print text section
+        write_words(fout, self.text_seg)
+        if not DEBUG:
+            return
+
+        labels = disassembly_labels(self.text_seg, self.symbols)
+        for line in disassemble(self.text_seg, labels):
+            log(1, "%s", line.expandtabs(8))
+
+    def record_data_section(self, fout):
+        write_words(fout, self.data_seg)
+        if not DEBUG:
+            return
+
+        cur_addr = MEM_DATA_START
+        for data in self.data_seg:
+            log(1, "0x%08x: 0x%08x", cur_addr, data)
+            cur_addr += BYTES_PER_WORD
+
+    def make_binary_file(self, fout):
+        if DEBUG:
+            log(1, "text size: %d, data size: %d",
+                self.text_section_size, self.data_section_size)
+
+        # print text_size, data_size
+        '''
+        blank: Print text section size and data section size
+        '''
+        fout.write("%s\n" % format_word(self.text_section_size))
+        fout.write("%s\n" % format_word(self.data_section_size))
+
+        phase = self.profile.phase if self.profile else no_phase
+        with phase('record text'):
+            self.record_text_section(fout)
+        with phase('record data'):
+            self.record_data_section(fout)
+
+    # same layout as make_binary_file, packed as big-endian words.
+    # fout has to be opened in binary mode
+    def make_packed_file(self, fout):
+        fout.write(OBJ_HEADER.pack(OBJ_MAGIC, self.text_section_size,
+                                   self.data_section_size))
+        phase = self.profile.phase if self.profile else no_phase
+        for name, seg in (('record text', self.text_seg),
+                          ('record data', self.data_seg)):
+            with phase(name):
+                for chunk in seg.chunks():
+                    fout.write(pack_words(chunk))
+
+    # copy both sections into one contiguous memory_image_t
+    def to_memory(self):
+        buffer = array('I')
+        for chunk in self.text_seg.chunks():
+            buffer.extend(chunk)
+        text_words = len(buffer)
+        for chunk in self.data_seg.chunks():
+            buffer.extend(chunk)
+        return memory_image_t(buffer, text_words)
+
+    ################################################
+    # Listing and symbol map
+    #
+    # Both come from what the run already holds:
+    # the listing entries recorded in the first
+    # pass, the encoded sections and the symbol
+    # table. Nothing is parsed again.
+    ################################################
+
+    # one row per source line: line number, address, first word, source.
+    # Lines that emit more than one word get a row per extra word
+    def write_listing(self, fout):
+        entries = self.listing or []
+        sizes = {section.TEXT.value: self.text_section_size,
+                 section.DATA.value: self.data_section_size}
+        bases = {section.TEXT.value: MEM_TEXT_START,
+                 section.DATA.value: MEM_DATA_START}
+
+        # a line ends where the next line of its section starts
+        ends = [0] * len(entries)
+        last = {}
+        for i, entry in enumerate(entries):
+            if entry[2] in last:
+                ends[last[entry[2]]] = entry[3]
+            last[entry[2]] = i
+        for sec, i in last.items():
+            ends[i] = sizes.get(sec, 0)
+
+        # (iterator, index of the current word, current word) per section
+        cursors = {section.TEXT.value: [iter(self.text_seg), -1, 0],
+                   section.DATA.value: [iter(self.data_seg), -1, 0]}
+        for (lineno, line, sec, start), end in zip(entries, ends):
+            if lineno is None:
+                continue
+            source = line.rstrip('\r\n')
+            cursor = cursors.get(sec)
+            if cursor is None:
+                fout.write("%6d  %8s  %8s  %s\n" % (lineno, '', '', source))
+                continue
+            base = bases[sec]
+            if end <= start:
+                fout.write("%6d  %08x  %8s  %s\n" % (lineno, base + start, '', source))
+                continue
+            first = True
+            for index in range(start // BYTES_PER_WORD,
+                               (end - 1) // BYTES_PER_WORD + 1):
+                while cursor[1] < index:
+                    cursor[2] = next(cursor[0])
+                    cursor[1] += 1
+                if first:
+                    fout.write("%6d  %08x  %08x  %s\n"
+                               % (lineno, base + start, cursor[2], source))
+                    first = False
+                else:
+                    fout.write("%6s  %08x  %08x\n"
+                               % ('', base + index * BYTES_PER_WORD, cursor[2]))
+
+    # symbols sorted by address, then name
+    def sorted_symbols(self):
+        return sorted(self.symbols, key=lambda s: (s.address, s.name))
+
+    def write_symbol_map_json(self, fout):
+        text_end = MEM_TEXT_START + self.text_section_size
+        json.dump({
+            'text': {'start': MEM_TEXT_START, 'size': self.text_section_size},
+            'data': {'start': MEM_DATA_START, 'size': self.data_section_size},
+            'symbols': [{'name': s.name, 'address': s.address,
+                         'section': 'text' if MEM_TEXT_START <= s.address <= text_end
+                                    else 'data'}
+                        for s in self.sorted_symbols()],
+        }, fout, indent=2)
+        fout.write('\n')
+
+    # nm style 'address type name' lines, sorted by address. The address
+    # is a fixed-width key, see find_symbol
+    def write_symbol_map(self, fout):
+        text_end = MEM_TEXT_START + self.text_section_size
+        for s in self.sorted_symbols():
+            kind = 'T' if MEM_TEXT_START <= s.address <= text_end else 'D'
+            fout.write("%08x %s %s\n" % (s.address, kind, s.name))
+
+    # packed words plus the exported symbols and the relocations of a
+    # relocatable run, fout in binary mode
+    def make_relocatable_file(self, fout):
+        text_end = MEM_TEXT_START + self.text_section_size
+        exports = []
+        for name in sorted(self.globals):
+            if name not in self.symbols:
+                continue
+            address = self.symbols.convert_label(name)
+            if MEM_TEXT_START <= address <= text_end:
+                exports.append((b'T', address - MEM_TEXT_START, name))
+            else:
+                exports.append((b'D', address - MEM_DATA_START, name))
+        relocs = self.relocs or []
+
+        fout.write(REL_HEADER.pack(REL_MAGIC, self.text_section_size,
+                                   self.data_section_size, len(exports),
+                                   len(relocs)))
+        for seg in (self.text_seg, self.data_seg):
+            for chunk in seg.chunks():
+                fout.write(pack_words(chunk))
+        for sec, offset, name in exports:
+            name = name.encode()
+            fout.write(REL_SYMBOL.pack(sec, offset, len(name)) + name)
+        for offset, rtype, name, addend in relocs:
+            name = name.encode()
+            fout.write(REL_ENTRY.pack(rtype, offset, addend, len(name)) + name)
+
+    def write_object(self, fout, format='text'):
+        if format == 'bin':
+            self.make_packed_file(fout)
+        elif format == 'rel':
+            self.make_relocatable_file(fout)
+        else:
+            self.make_binary_file(fout)
+
+    def close(self):
+        self.text_seg.close()
+        self.data_seg.close()
+
+
+def section_size(image, sec):
+    if sec == section.TEXT.value:
+        return image.text_section_size
+    return image.data_section_size
+
+
+# the trailing data lines listed at offset before (labels, comments)
+# move to after, the aligned start of the next directive
+def realign_listing(listing, before, after):
+    i = len(listing) - 1
+    while i >= 0 and listing[i][2] == section.DATA.value and listing[i][3] == before:
+        listing[i] = listing[i][:3] + (after,)
+        i -= 1
+
+
+################################################
+# Profiling
+#
+# Wall time per phase and run counters, filled
+# in by an Assembler created with profile=.
+################################################
+
+def no_phase(name):
+    return contextlib.nullcontext()
+
+
+class profile_t:
+    def __init__(self, memory=False):
+        # phase name -> seconds, in the order the phases first ran
+        self.phases = {}
+        self.counters = {}
+        # tracemalloc slows down every allocation, allocation-heavy
+        # phases more than others, so peak memory is only traced on
+        # request and the times of such a run are not comparable
+        self.memory = memory
+        self.peak_memory = None
+
+    def start_memory(self):
+        if self.memory:
+            tracemalloc.start()
+
+    def stop_memory(self):
+        if self.memory:
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    def add_time(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - t0)
+
+    def count(self, name, n):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    # yields the lines of input, charging the time spent getting them
+    # to the 'read' phase
+    def timed_lines(self, input):
+        clock = time.perf_counter
+        read = 0.0
+        it = iter(input)
+        try:
+            while True:
+                t0 = clock()
+                try:
+                    line = next(it)
+                except StopIteration:
+                    read += clock() - t0
+                    return
+                read += clock() - t0
+                yield line
+        finally:
+            self.add_time('read', read)
+
+    def to_dict(self):
+        return {
+            'version': ASSEMBLER_VERSION,
+            'phases': {name: round(t, 6) for name, t in self.phases.items()},
+            'total': round(sum(self.phases.values()), 6),
+            'counters': dict(self.counters),
+            'peak_memory': self.peak_memory,
+        }
+
+    def report(self):
+        total = sum(self.phases.values()) or 1e-9
+        log(2, "profile:")
+        for name, t in self.phases.items():
+            log(1, "  %-12s %9.3f ms %5.1f%%", name, t * 1e3, t / total * 100,
+                level=LOG_ALWAYS)
+        log(1, "  %-12s %9.3f ms", 'total', total * 1e3, level=LOG_ALWAYS)
+        for name, n in self.counters.items():
+            log(1, "  %-18s %d", name, n, level=LOG_ALWAYS)
+        if self.peak_memory is not None:
+            log(1, "  %-18s %.1f KiB (times include tracemalloc overhead)",
+                'peak memory', self.peak_memory / 1024, level=LOG_ALWAYS)
+
+
+################################################
+# Memory Image
+#
+# The assembled program as one contiguous word
+# buffer, text words first and data words right
+# after. text and data are zero-copy memoryview
+# slices of that buffer, indexed by word, for a
+# simulator running in the same process.
+################################################
+
+class memory_image_t:
+    def __init__(self, buffer, text_words):
+        self.buffer = buffer
+        self.text_start = MEM_TEXT_START
+        self.data_start = MEM_DATA_START
+        view = memoryview(buffer)
+        self.text = view[:text_words]
+        self.data = view[text_words:]
+
+    # the section view holding address and the word index inside it
+    def locate(self, address):
+        for start, view in ((self.text_start, self.text),
+                            (self.data_start, self.data)):
+            index = (address - start) // BYTES_PER_WORD
+            if address >= start and index < len(view):
+                return view, index
+        raise IndexError(f"Address 0x{address:08x} is outside the image")
+
+    def load_word(self, address):
+        view, index = self.locate(address)
+        return view[index]
+
+    def release(self):
+        self.text.release()
+        self.data.release()
+
+
+# '0'/'1' lines of every word of a section_buffer_t, one write per
+# WRITE_CHUNK_WORDS words instead of two per word
+def write_words(fout, seg):
+    for chunk in seg.chunks():
+        for i in range(0, len(chunk), WRITE_CHUNK_WORDS):
+            lines = map(format_word, chunk[i:i + WRITE_CHUNK_WORDS])
+            fout.write('\n'.join(lines))
+            fout.write('\n')
+
+
+def pack_words(words):
+    if sys.byteorder == 'little':
+        words = array('I', words)
+        words.byteswap()
+    return words.tobytes()
+
+
+def unpack_words(data):
+    words = array('I')
+    words.frombytes(data)
+    if sys.byteorder == 'little':
+        words.byteswap()
+    return words
+
+
+# read back an image written by make_packed_file. The packed format
+# carries no symbols, so the returned image has an empty symbol table
+def load_packed_image(fin, spill_words=SECTION_SPILL_WORDS):
+    header = fin.read(OBJ_HEADER.size)
+    if len(header) != OBJ_HEADER.size:
+        raise asm_error("Truncated object header")
+    magic, text_size, data_size = OBJ_HEADER.unpack(header)
+    if magic != OBJ_MAGIC:
+        raise asm_error("Not a packed MIPS object file")
+
+    image = ObjectImage(spill_words)
+    image.text_section_size = text_size
+    image.data_section_size = data_size
+    for seg, size in ((image.text_seg, text_size), (image.data_seg, data_size)):
+        data = fin.read(size)
+        if len(data) != size:
+            raise asm_error("Truncated object file")
+        seg.extend(unpack_words(data))
+    return image
+
+
+# (address, type, name) of the symbol at or before address in a map
+# written by write_symbol_map, found by binary search on the file
+# offsets. fin has to be opened in binary mode
+def find_symbol(fin, address):
+    fin.seek(0, os.SEEK_END)
+    lo, hi = 0, fin.tell()
+    best = None
+    # invariant: every line starting before lo has an address <= address
+    while lo < hi:
+        mid = (lo + hi) // 2
+        # first line starting at or after mid
+        if mid > 0:
+            fin.seek(mid - 1)
+            fin.readline()
+        else:
+            fin.seek(0)
+        pos = fin.tell()
+        line = fin.readline()
+        if pos >= hi or not line:
+            hi = mid
             continue
+        entry_address = int(line[:8], 16)
+        if entry_address <= address:
+            best = line
+            lo = fin.tell()
+        else:
+            hi = mid
+    if best is None:
+        return None
+    addr, kind, name = best.decode().split()
+    return int(addr, 16), kind, name
+
+
+# an object in the '0'/'1' text format of make_binary_file
+def load_text_image(fin, spill_words=SECTION_SPILL_WORDS):
+    lines = iter(fin)
+    try:
+        text_size = int(next(lines), 2)
+        data_size = int(next(lines), 2)
+    except (StopIteration, ValueError):
+        raise asm_error("Not a MIPS object file") from None
+
+    image = ObjectImage(spill_words)
+    image.text_section_size = text_size
+    image.data_section_size = data_size
+    for seg, size in ((image.text_seg, text_size), (image.data_seg, data_size)):
+        left = size // BYTES_PER_WORD
+        while left > 0:
+            chunk = list(itertools.islice(lines, min(left, WRITE_CHUNK_WORDS)))
+            if not chunk:
+                raise asm_error("Truncated object file")
+            try:
+                seg.extend(array('I', [int(line, 2) for line in chunk]))
+            except ValueError:
+                raise asm_error("Invalid word in object file") from None
+            left -= len(chunk)
+    return image
+
+
+# either object format, told apart by the packed magic
+def load_object(path, spill_words=SECTION_SPILL_WORDS):
+    with open(path, 'rb') as f:
+        magic = f.read(len(OBJ_MAGIC))
+    if magic == OBJ_MAGIC:
+        with open(path, 'rb') as f:
+            return load_packed_image(f, spill_words)
+    if magic == REL_MAGIC:
+        with open(path, 'rb') as f:
+            return load_relocatable(f, spill_words)
+    with open(path, 'r') as f:
+        return load_text_image(f, spill_words)
+
+
+def output_mode(format):
+    return 'w' if format == 'text' else 'wb'
+
+
+# '-' is stdout, which is never closed; everything else a file
+# opened with a WRITE_BUFFER_BYTES buffer
+def open_output(path, format):
+    if path == '-':
+        return sys.stdout if format == 'text' else sys.stdout.buffer
+    return open(path, output_mode(format), buffering=WRITE_BUFFER_BYTES)
+
+
+def close_output(fout):
+    if fout is sys.stdout or fout is sys.stdout.buffer:
+        fout.flush()
+    else:
+        fout.close()
 
-        if cur_section == section.DATA.value:
-            '''
-            blank
-            '''
-            if temp[-1] == ':':
-                symbol = symbol_t()
-                symbol.name = temp[:-1]
-                symbol.address = ctypes.c_uint(address).value
-                symbol_table_add_entry(symbol)
-
-            word = line.find(".word")
-            global data_section_size
-            if word != -1:
-                data_seg.write("%s\n" % line[word:])
-                data_section_size += BYTES_PER_WORD
-
-        elif cur_section == section.TEXT.value:
-            '''
-            blank
-            '''
-            if temp[-1] == ":":
-                symbol = symbol_t()
-                symbol.name = temp[:-1]
-                symbol.address = ctypes.c_uint(address).value
-                symbol_table_add_entry(symbol)
+
+# main(argv) for the command line. When the reader of stdout goes away
+# (e.g. '| head') the run stops quietly; stdout is pointed at /dev/null
+# so the interpreter's last flush can't fail again
+def run_main(main, argv):
+    try:
+        return main(argv)
+    except BrokenPipeError:
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+
+
+################################################
+# Relocatable Objects
+#
+# A relocatable run encodes every instruction as
+# usual, with 0 for labels that are not defined
+# in the file, and records a relocation for each
+# word whose value depends on where the linker
+# puts the sections:
+#   R_26    j / jal target field
+#   R_HI16  upper half of la / %hi
+#   R_LO16  lower half of la / %lo
+#   R_PC16  beq / bne to an external label
+# A relocation names an external symbol, or
+# '.text' / '.data' with the label's offset in
+# that section as addend.
+################################################
+
+R_26 = 1
+R_HI16 = 2
+R_LO16 = 3
+R_PC16 = 4
+
+RELOC_NAMES = {R_26: 'R_26', R_HI16: 'R_HI16', R_LO16: 'R_LO16', R_PC16: 'R_PC16'}
+
+
+# symbol table proxy of a relocatable run, labels defined in other
+# files resolve to 0
+class extern_table_t:
+    def __init__(self, symbols):
+        self.symbols = symbols
+
+    def convert_label(self, label):
+        if label in self.symbols:
+            return self.symbols.convert_label(label)
+        return 0
+
+
+def reloc_type(name, kind):
+    if kind == OP_HI:
+        return R_HI16
+    if kind == OP_LO:
+        return R_LO16
+    if name == 'j' or name == 'jal':
+        return R_26
+    return R_PC16
+
+
+# word with the field of rtype set for a symbol at value, the word
+# being at address
+def apply_reloc(word, rtype, value, address):
+    if rtype == R_26:
+        return word & 0xfc000000 | (value >> 2) & 0x3ffffff
+    if rtype == R_HI16:
+        return word & 0xffff0000 | (value >> 16) & 0xffff
+    if rtype == R_LO16:
+        return word & 0xffff0000 | value & 0xffff
+    offset = (value - address - BYTES_PER_WORD) >> 2
+    if not -0x8000 <= offset < 0x8000:
+        raise asm_error(f"Branch at 0x{address:08x} out of range of 0x{value:08x}")
+    return word & 0xffff0000 | offset & 0xffff
+
+
+def load_relocatable(fin, spill_words=SECTION_SPILL_WORDS):
+    header = fin.read(REL_HEADER.size)
+    if len(header) != REL_HEADER.size:
+        raise asm_error("Truncated object header")
+    magic, text_size, data_size, n_symbols, n_relocs = REL_HEADER.unpack(header)
+    if magic != REL_MAGIC:
+        raise asm_error("Not a relocatable MIPS object file")
+
+    image = ObjectImage(spill_words)
+    image.text_section_size = text_size
+    image.data_section_size = data_size
+    for seg, size in ((image.text_seg, text_size), (image.data_seg, data_size)):
+        data = fin.read(size)
+        if len(data) != size:
+            raise asm_error("Truncated object file")
+        seg.extend(unpack_words(data))
+
+    def read_name(length):
+        name = fin.read(length)
+        if len(name) != length:
+            raise asm_error("Truncated object file")
+        return name.decode()
+
+    for _ in range(n_symbols):
+        sec, offset, length = REL_SYMBOL.unpack(fin.read(REL_SYMBOL.size))
+        name = read_name(length)
+        image.add_label(name, (MEM_TEXT_START if sec == b'T' else MEM_DATA_START) + offset)
+        image.globals.add(name)
+    image.relocs = []
+    for _ in range(n_relocs):
+        rtype, offset, addend, length = REL_ENTRY.unpack(fin.read(REL_ENTRY.size))
+        image.relocs.append((offset, rtype, read_name(length), addend))
+    return image
+
+
+################################################
+# Assembly Cache
+#
+# Finished images keyed by a hash of the source,
+# ASSEMBLER_VERSION and the memory layout. An
+# entry is a packed object (make_packed_file)
+# followed by the symbol table as text lines.
+# Entries are touched on every hit and the least
+# recently used ones are evicted once the cache
+# grows past max_bytes, down to 3/4 of it. The
+# directory is scanned on the first store and
+# then only when the stores since pass the
+# bound; with max_bytes
+# None (batch workers) nothing is evicted and
+# assemble_batch calls evict() once at the end.
+################################################
+
+class assembly_cache_t:
+    def __init__(self, cache_dir, max_bytes=CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # bytes in cache_dir as of the last scan plus this object's
+        # stores since, None before the first scan
+        self.size = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def new_key(self):
+        key = hashlib.sha256()
+        key.update(f"{ASSEMBLER_VERSION}:{MEM_TEXT_START:08x}:"
+                   f"{MEM_DATA_START:08x}\n".encode())
+        return key
+
+    def key_for_source(self, source):
+        key = self.new_key()
+        key.update(source.encode())
+        return key.hexdigest()
+
+    def key_for_file(self, path):
+        key = self.new_key()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                key.update(block)
+        return key.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key + '.o')
+
+    def lookup(self, key, spill_words=SECTION_SPILL_WORDS):
+        path = self.entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                image = load_packed_image(f, spill_words)
+                for line in f.read().decode().splitlines():
+                    name, address = line.split()
+                    image.add_label(name, int(address, 16))
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (asm_error, ValueError):
+            # a damaged entry is a miss, the store after it replaces it
+            self.misses += 1
+            return None
+        self.hits += 1
+        return image
+
+    def store(self, key, image):
+        path = self.entry_path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            image.make_packed_file(f)
+            f.write(''.join(f"{symbol.name} {symbol.address:08x}\n"
+                            for symbol in image.symbols).encode())
+            size = f.tell()
+        os.replace(tmp_path, path)
+        if self.max_bytes is None:
+            return
+        if self.size is None or self.size + size > self.max_bytes:
+            self.evict()
+        else:
+            self.size += size
+
+    def evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.o'):
                 continue
-            global text_section_size 
-            cnt = 1
-            if temp == 'la':
-                target = str(hex(convert_label(token_line[2])))
-                text_seg.write(convert_mips_to_binary('lui\t'+token_line[1]+'\t'+target[:-4])+'\n')
-                cnt = 1
-            elif temp == 'move':
-                text_seg.write(convert_mips_to_binary('addi\t'+token_line[1]+'\t'+token_line[2]+',\t0')+'\n')
-                cnt = 1
-            elif temp == 'blt':
-                text_seg.write(convert_mips_to_binary('slt\t$1,\t'+token_line[1]+'\t'+token_line[2])+'\n')
-                text_seg.write(convert_mips_to_binary('bne\t$1,\t0,\t'+token_line[3])+'\n')
-                cnt = 2
-            elif temp == 'push': #todo
-                text_seg.write(convert_mips_to_binary('addi\t$29,\t$29,\t-4')+'\n')
-                text_seg.write(convert_mips_to_binary('sw\t'+token_line[1]+'\t0($29)\n')+'\n')
-                cnt = 2
-            elif temp == 'pop':
-                text_seg.write(convert_mips_to_binary('lw\t'+token_line[1]+'\t0($29)\n')+'\n')
-                text_seg.write(convert_mips_to_binary('addi\t$29,\t$29,\t4')+'\n')
-                cnt = 2
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+
+        if total <= self.max_bytes:
+            self.size = total
+            return
+        # down to a low-water mark, so the next scan is a good
+        # number of stores away
+        target = self.max_bytes * 3 // 4
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+        self.size = total
+
+    def report(self):
+        log(1, "cache: %d hits, %d misses, %d evictions",
+            self.hits, self.misses, self.evictions, level=LOG_ALWAYS)
+
+
+################################################
+# Incremental Assembly
+#
+# The text section is cut into blocks at every
+# label line. An incremental Assembler keeps the
+# blocks of its previous run keyed by their
+# first source line. When the first pass meets
+# that line again, followed by the same raw
+# lines, the whole block is taken over without
+# lexing, sizing or encoding it: only its
+# instructions that use a label are encoded
+# again, and only if the block or one of those
+# labels moved. Section switches and .globl end
+# a block, so a block is plain instructions and
+# may start anywhere a previous one did.
+################################################
+
+# directives that end a block, a reused block must not skip them
+BLOCK_ENDS = ('.data', '.text', '.globl')
+
+
+class text_block_t:
+    def __init__(self, labels, index, start, lineno, first):
+        # labels of the first line, none for text before the first label
+        self.labels = labels
+        # position of the first line in the source list
+        self.index = index
+        self.start = start
+        self.lineno = lineno
+        # raw source lines
+        self.lines = None
+        # text_ir entries, as made for the run at origin (address, line)
+        self.first = first
+        self.entries = None
+        self.origin = (start, lineno)
+        self.size = 0
+        self.pseudo_ops = 0
+        # (label, address or None) of every label the pseudo-op
+        # expansion looked at, their sizes depend on them
+        self.expand_refs = []
+        self.words = None
+        # (entry index, labels) of the entries that use a label
+        self.refs = None
+        self.ref_labels = None
+        # the block of the previous run this one takes over
+        self.prev = None
+
+    # the same block at another address / line of this run
+    def moved_to(self, index, start, lineno):
+        block = text_block_t(self.labels, index, start, lineno, None)
+        for name in ('lines', 'entries', 'origin', 'size',
+                     'pseudo_ops', 'expand_refs'):
+            setattr(block, name, getattr(self, name))
+        block.prev = self
+        return block
+
+    # the entry at i with this run's address and line number
+    def entry(self, i):
+        address, name, operands, lineno = self.entries[i]
+        return (address + self.start - self.origin[0], name, operands,
+                lineno + self.lineno - self.origin[1])
+
+
+# the blocks of one incremental first pass, see Assembler.make_symbol_table
+class block_pass_t:
+    def __init__(self, lines, prev_blocks, symbols):
+        self.lines = lines
+        self.prev_blocks = prev_blocks
+        self.blocks = []
+        self.current = None
+        # the symbol table pseudo-ops are expanded against
+        self.expand_symbols = expand_recorder_t(symbols)
+
+    def open(self, labels, lineno, address, text_ir, pseudo_ops):
+        self.close(lineno - 1, text_ir, pseudo_ops)
+        block = text_block_t(labels, lineno - 1, address, lineno, len(text_ir))
+        block.pseudo_ops = pseudo_ops
+        self.expand_symbols.refs = block.expand_refs
+        self.blocks.append(block)
+        self.current = block
+
+    # end the open block before the line at index end
+    def close(self, end, text_ir, pseudo_ops):
+        block = self.current
+        if block is None:
+            return
+        block.lines = self.lines[block.index:end]
+        block.entries = text_ir[block.first:]
+        block.size = len(block.entries) * BYTES_PER_WORD
+        block.pseudo_ops = pseudo_ops - block.pseudo_ops
+        self.current = None
+
+    # the block of the previous run starting with line, if the source
+    # and the labels its pseudo-ops were sized against are unchanged.
+    # Its own labels will be at address
+    def match(self, line, lineno, address, symbols):
+        prev = self.prev_blocks.get(line)
+        if prev is None:
+            return None
+        start = lineno - 1
+        if self.lines[start:start + len(prev.lines)] != prev.lines:
+            return None
+        for label, known in prev.expand_refs:
+            if label in prev.labels:
+                now = address
+            elif label in symbols:
+                now = symbols.convert_label(label)
             else:
-                text_seg.write(convert_mips_to_binary(line) + '\n')
-                cnt = 1
-            address += BYTES_PER_WORD * cnt
-            text_section_size += BYTES_PER_WORD * cnt
-                
-
-
-#create mips instructions: la, move, blt, push, pop and else
-def record_text_section(fout):
-    # print text section
-    cur_addr = MEM_TEXT_START
-    text_seg.seek(0)
-
-    lines = text_seg.readlines()
-    for line in lines:
-        line = line.strip()
-        inst_type, rs, rt, rd, imm, shamt = '0', 0, 0, 0, 0, 0
-        
-        '''
-        blank: Find the instruction type that matches the line
-        '''
-        # for i in inst_list: 
-        #     if i.op == line[:6]:
-        #         inst_type = i.type 
-        #         op = i.op
-        #         funct = i.funct
-        #         if i.type == 'R': 
-        #             rd = int(line[16:21], 2)
-        #             rs = int(line[6:11], 2)
-        #             rt = int(line[11:16], 2)
-        #             shamt = int(line[21:26], 2)
-        #         elif i.type == 'I': 
-        #             rs = int(line[6:11], 2)
-        #             rt = int(line[11:16], 2)
-        #             imm = int(line[16:], 2)
-        #         elif i.type == 'J':
-        #             adr = int(line[6:], 2)
-        fout.write(line)
-        # if inst_type == 'R':
-        #     '''
-        #     blank
-        #     '''
-        #     print(funct)
-        #     # fout.write(num_to_bits(int(op + num_to_bits(rs, 5) + num_to_bits(rt, 5) + num_to_bits(rd, 5) + num_to_bits(shamt, 5) + funct, 2), 32))
-        #     fout.write(op + str(num_to_bits(rs, 5)) + str(num_to_bits(rt, 5)) + str(num_to_bits(rd, 5)) + str(num_to_bits(shamt, 5)) + funct)
-        # if inst_type == 'I':
-        #     '''
-        #     blank
-        #     '''
-        #     fout.write(num_to_bits(int(op + num_to_bits(rs, 5) + num_to_bits(rt, 5) + num_to_bits(imm, 16), 2), 32))
-
-        # if inst_type == 'J':
-        #     '''
-        #     blank
-        #     '''
-        #     fout.write(num_to_bits(int(op + num_to_bits(adr, 26), 2), 32))
-
-        # if DEBUG:
-        #     if inst_type == 'R':
-        #         log(1, f"0x{hex(cur_addr)[2:].zfill(8)}: op: {op} rs:${rs} rt:${rt} rd:${rd} shamt:{shamt} funct:{i.funct}")
-        #     elif inst_type == 'I':
-        #         log(1, f"0x{hex(cur_addr)[2:].zfill(8)}: op:{op} rs:${rs} rt:${rt} imm:0x{hex(imm)[2:].zfill(4)}")
-        #     elif inst_type == 'J':
-        #         log(1, f"0x{hex(cur_addr)[2:].zfill(8)}: op:{op} addr:{hex(adr)[2:].zfill(8)}")
-
-        fout.write("\n")
-        cur_addr += BYTES_PER_WORD
-
-
-def record_data_section(fout):
-    cur_addr = MEM_DATA_START
-    data_seg.seek(0)
-
-    lines = data_seg.readlines()
-    
-    for line in lines:
-        '''
-        blank
-        '''
-        line = line.strip()
-        token_line = line.strip('\n\t').split()
-        data = token_line[-1]
-        data = int(data, 0)
-        fout.write("%s\n" % num_to_bits(data, 32))
+                now = None
+            if now != known:
+                return None
+        return prev
 
-        if DEBUG:
-            log(1, f"0x" + hex(cur_addr)[2:].zfill(8) + f": {line}")
+    def reuse(self, prev, lineno, address, text_ir, pseudo_ops):
+        self.close(lineno - 1, text_ir, pseudo_ops)
+        self.blocks.append(prev.moved_to(lineno - 1, address, lineno))
 
-        cur_addr += BYTES_PER_WORD
 
+# symbol table proxy for pseudo-op expansion that remembers every label
+# looked at, and its address when it was known
+class expand_recorder_t:
+    def __init__(self, symbols):
+        self.symbols = symbols
+        self.refs = []
 
-def make_binary_file(fout):
-    if DEBUG:
-        # print assembly code of text section
-        text_seg.seek(0)
-        lines = text_seg.readlines()
-        for line in lines:
-            line = line.strip()
+    def __contains__(self, label):
+        if label in self.symbols:
+            return True
+        self.refs.append((label, None))
+        return False
 
-    if DEBUG:
-        log(1,
-            f"text size: {text_section_size}, data size: {data_section_size}")
+    def convert_label(self, label):
+        address = self.symbols.convert_label(label)
+        self.refs.append((label, address))
+        return address
 
-    # print text_size, data_size
-    '''
-    blank: Print text section size and data section size
-    '''
-    fout.write("%s\n" % num_to_bits(int(text_section_size),32))
-    fout.write("%s\n" % num_to_bits(int(data_section_size),32))
 
-    record_text_section(fout)
-    record_data_section(fout)
+# symbol table proxy that remembers every label an encoder resolves
+class ref_recorder_t:
+    def __init__(self, symbols):
+        self.symbols = symbols
+        self.refs = []
+
+    def convert_label(self, label):
+        self.refs.append(label)
+        return self.symbols.convert_label(label)
+
+
+################################################
+# Streaming Encoding
+#
+# One pass over the input: an instruction is
+# encoded as soon as it is read, unless it uses
+# a label that is not defined yet. Then a
+# placeholder word is emitted and the
+# instruction waits under that label until
+# define() patches it in, so only forward
+# references are held in memory.
+################################################
+
+LABEL_OPERANDS = (OP_LABEL, OP_HI, OP_LO)
+
+
+def unresolved_label(operands, symbols):
+    for kind, value in operands:
+        if kind in LABEL_OPERANDS and value not in symbols:
+            return value
+    return None
+
+
+# stands in for the text_ir list of make_symbol_table
+class stream_text_t:
+    def __init__(self, image):
+        self.image = image
+        # label -> [(word index, text_ir entry), ...]
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.image.text_seg)
+
+    def append(self, entry):
+        address, name, operands, lineno = entry
+        text_seg = self.image.text_seg
+        label = unresolved_label(operands, self.image.symbols)
+        if label is None:
+            text_seg.append(encode_tokens(name, operands, address,
+                                          self.image.symbols))
+            return
+        self.pending.setdefault(label, []).append((len(text_seg), entry))
+        text_seg.append(0)
+
+    # encode the instructions waiting on label. Called while the line
+    # defining it is read, so errors name the instruction's own line
+    def define(self, label):
+        for index, (address, name, operands, lineno) in self.pending.pop(label, ()):
+            try:
+                word = encode_tokens(name, operands, address, self.image.symbols)
+            except asm_error as e:
+                raise asm_error(f"{e} (instruction at line {lineno})") from None
+            self.image.text_seg.patch(index, word)
+
+    def finish(self):
+        for label, refs in self.pending.items():
+            raise asm_error(f"line {refs[0][1][3]}: Undefined label {label}")
+
+
+################################################
+# Assembler
+#
+# An Assembler only holds its settings, all the
+# state of a run lives in the ObjectImage it
+# returns. One instance can assemble any number
+# of files back to back, from any thread.
+#
+# The exception is incremental mode: then the
+# Assembler keeps the blocks of its last run and
+# only lexes and encodes the ones that changed,
+# so it should be used for one program from one
+# thread.
+# bench/check_incremental.py compares it with a
+# full rebuild over a series of edits.
+################################################
+
+class Assembler:
+    def __init__(self, spill_words=SECTION_SPILL_WORDS, cache=None,
+                 incremental=False, profile=None, listing=False,
+                 relocatable=False, jobs=None):
+        self.spill_words = spill_words
+        # worker processes for the second pass, see encode_parallel
+        self.jobs = jobs
+        # leave labels of other files to the linker, see encode_relocatable
+        self.relocatable = relocatable
+        # record the source lines for ObjectImage.write_listing
+        self.listing = listing
+        self.cache = cache
+        self.profile = profile
+        # a cached, relocatable or parallel run never reaches encode_blocks,
+        # and a reused block has no listing lines
+        if incremental and (cache is not None or relocatable or jobs or listing):
+            raise asm_error("Incremental mode can't be combined with a cache, "
+                            "relocatable output, encode jobs or a listing")
+        self.incremental = incremental
+        # first source line -> text_block_t of the previous run
+        self.prev_blocks = {}
+        # label -> address of the previous run
+        self.prev_symbols = {}
+
+    # source is the program text or an iterable of lines (e.g. a file).
+    # Only program text is looked up in the cache
+    def assemble(self, source):
+        if isinstance(source, str):
+            if self.cache is not None:
+                return self.assemble_cached(self.cache.key_for_source(source),
+                                            source.splitlines())
+            source = source.splitlines()
+        image = self.new_image()
+        self.make_symbol_table(source, image)
+        return image
+
+    def new_image(self):
+        image = ObjectImage(self.spill_words)
+        image.profile = self.profile
+        if self.listing:
+            image.listing = []
+        return image
+
+    def assemble_file(self, path):
+        if self.cache is not None:
+            key = self.cache.key_for_file(path)
+            with open(path, 'r') as f:
+                return self.assemble_cached(key, f)
+        with open(path, 'r') as f:
+            return self.assemble(f)
+
+    def assemble_cached(self, key, lines):
+        image = self.cache.lookup(key, self.spill_words)
+        if image is None:
+            image = self.new_image()
+            self.make_symbol_table(lines, image)
+            self.cache.store(key, image)
+        else:
+            image.profile = self.profile
+        return image
+
+    # single pass over an iterable of lines (e.g. sys.stdin) that keeps
+    # only the instructions waiting on a forward label
+    def assemble_stream(self, lines):
+        # relocations are recorded in the second pass
+        if self.relocatable:
+            return self.assemble(list(lines))
+        image = self.new_image()
+        self.make_symbol_table(lines, image, stream_text_t(image))
+        return image
+
+    def assemble_to_memory(self, source):
+        image = self.assemble(source)
+        try:
+            return image.to_memory()
+        finally:
+            image.close()
+
+    def make_symbol_table(self, input, image, stream=None):
+        cur_section = section.MAX_SIZE.value
+        # enum members cost an attribute lookup each, the loop
+        # below compares against them on every line
+        DATA, TEXT = section.DATA.value, section.TEXT.value
+
+        # tokenised text instructions as (address, name, operands, line),
+        # shared by both passes. A stream_text_t encodes them right away
+        text_ir = []
+        if stream is not None:
+            text_ir = stream
+        lineno = pseudo_ops = 0
+        # data labels waiting for the next data directive
+        data_labels = []
+        # pseudo-ops are sized against the labels known so far. In a
+        # relocatable run none count, the linker may move every label
+        expand_symbols = symbol_table_t() if self.relocatable else image.symbols
+        blocks = None
+        if self.incremental and stream is None:
+            # blocks of the last run are matched against the raw lines
+            input = list(input)
+            blocks = block_pass_t(input, self.prev_blocks, expand_symbols)
+            expand_symbols = blocks.expand_symbols
+
+        profile = self.profile
+        if profile:
+            input = profile.timed_lines(input)
+            t0 = time.perf_counter()
+
+        # first pass: record label addresses and size every instruction.
+        # The input is read line by line, only the tokens of text
+        # instructions are kept for the second pass
+        listing = image.listing
+        numbered = enumerate(input, 1)
+        for lineno, line in numbered:
+            if listing is not None:
+                listing.append((lineno, line, cur_section,
+                                section_size(image, cur_section)))
+            try:
+                if cur_section == DATA:
+                    data_line = lex_data_line(line)
+                    if data_line is not None:
+                        labels, name, values = data_line
+                        data_labels.extend(labels)
+                        self.add_data(image, name, values, data_labels, stream)
+                        continue
+
+                if blocks is not None and cur_section == TEXT:
+                    address = MEM_TEXT_START + image.text_section_size
+                    prev = blocks.match(line, lineno, address, image.symbols)
+                    if prev is not None:
+                        if data_labels:
+                            self.place_data_labels(image, data_labels, stream)
+                        blocks.reuse(prev, lineno, address, text_ir, pseudo_ops)
+                        for label in prev.labels:
+                            image.add_label(label, address)
+                        image.text_section_size += prev.size
+                        pseudo_ops += prev.pseudo_ops
+                        # skip the rest of the block
+                        skip = len(prev.lines) - 1
+                        next(itertools.islice(numbered, skip, skip), None)
+                        lineno += skip
+                        continue
+
+                labels, name, operands = lex_line(line)
+                if blocks is not None:
+                    ends_block = name in BLOCK_ENDS
+                    if labels or ends_block:
+                        blocks.close(lineno - 1, text_ir, pseudo_ops)
+
+                if name == ".data":
+                    cur_section = DATA
+                    name = None
+                elif name == '.text':
+                    cur_section = TEXT
+                    name = None
+                elif name == '.globl':
+                    for op in operands:
+                        if op[0] != OP_LABEL:
+                            raise asm_error(f"Invalid .globl name {format_operand(op)}")
+                        image.globals.add(op[1])
+                    name = None
+                if listing is not None and name is None and cur_section != listing[-1][2]:
+                    # a section switch is listed in the section it opens
+                    listing[-1] = listing[-1][:2] + (cur_section, section_size(image, cur_section))
+
+                if cur_section == DATA:
+                    # a label takes the address of the next directive,
+                    # after that one's alignment
+                    data_labels.extend(labels)
+                    if name is None:
+                        continue
+                    if name not in DATA_DIRECTIVES:
+                        raise asm_error(f"Unsupported data directive {name}")
+                    for op in operands:
+                        if op[0] != OP_IMM:
+                            raise asm_error(f"Invalid {name} value {format_operand(op)}")
+                    self.add_data(image, name, [op[1] for op in operands],
+                                  data_labels, stream)
+                    continue
+
+                if data_labels:
+                    self.place_data_labels(image, data_labels, stream)
+
+                if cur_section == TEXT:
+                    if blocks is not None and blocks.current is None and \
+                            (labels or name is not None) and not ends_block:
+                        blocks.open(labels, lineno, MEM_TEXT_START + image.text_section_size,
+                                    text_ir, pseudo_ops)
+                    for label in labels:
+                        image.add_label(label, MEM_TEXT_START + image.text_section_size)
+                        if stream is not None:
+                            stream.define(label)
+                    if name is None:
+                        continue
+                    address = MEM_TEXT_START + image.text_section_size
+                    if name == '.word':
+                        # one text word per value
+                        for op in operands:
+                            if op[0] != OP_IMM:
+                                raise asm_error(f"Invalid {name} value {format_operand(op)}")
+                            text_ir.append((address, name, (op,), lineno))
+                            address += BYTES_PER_WORD
+                        image.text_section_size = address - MEM_TEXT_START
+                        continue
+                    pseudo = PSEUDO_TABLE.get(name)
+                    if pseudo is None:
+                        if name not in INST_DISPATCH:
+                            raise asm_error(f"Unknown instruction {name}")
+                        text_ir.append((address, name, operands, lineno))
+                        image.text_section_size += BYTES_PER_WORD
+                        continue
+                    pseudo_ops += 1
+                    for base_name, base_operands in pseudo.expand(operands, expand_symbols):
+                        text_ir.append((address, base_name, base_operands, lineno))
+                        address += BYTES_PER_WORD
+                    image.text_section_size = address - MEM_TEXT_START
+            except asm_error as e:
+                raise asm_error(f"line {lineno}: {e}") from None
+
+        if blocks is not None:
+            blocks.close(len(blocks.lines), text_ir, pseudo_ops)
+        # labels at the very end of .data, then pad the last word
+        self.place_data_labels(image, data_labels, stream)
+        if listing is not None:
+            # end markers, the padding below belongs to no line
+            listing.append((None, None, section.DATA.value, image.data_section_size))
+            listing.append((None, None, section.TEXT.value, image.text_section_size))
+        image.align_data(BYTES_PER_WORD)
+
+        if profile:
+            elapsed = time.perf_counter() - t0
+            profile.add_time('first pass', elapsed - profile.phases.get('read', 0.0))
+            profile.count('lines', lineno)
+            # reused blocks of an incremental run are not in text_ir
+            profile.count('instructions', image.text_section_size // BYTES_PER_WORD)
+            profile.count('pseudo-ops', pseudo_ops)
+            profile.count('symbols', len(image.symbols))
+
+        # second pass: every label is known now, encode the text section.
+        # A stream has encoded it already, only undefined labels are left
+        with profile.phase('encode') if profile else contextlib.nullcontext():
+            if stream is not None:
+                stream.finish()
+            elif self.relocatable:
+                self.encode_relocatable(image, text_ir)
+            elif blocks is not None:
+                self.encode_blocks(image, blocks.blocks)
+            elif self.jobs and len(text_ir) >= PARALLEL_MIN_WORDS:
+                self.encode_parallel(image, text_ir)
+            else:
+                emit_text = image.text_seg.append
+                for entry in text_ir:
+                    self.encode_text(emit_text, image.symbols, entry)
+
+        if profile:
+            profile.count('symbol lookups', image.symbols.lookups)
+            profile.count('text words', len(image.text_seg))
+            profile.count('data words', len(image.data_seg))
+
+    # one data directive with all its values, labels are the ones
+    # waiting for it
+    def add_data(self, image, name, values, labels, stream):
+        if not values:
+            raise asm_error(f"{name} needs a value")
+        directive = DATA_DIRECTIVES[name]
+        before = image.data_section_size
+        image.align_data(directive.align)
+        if image.listing is not None and image.data_section_size != before:
+            realign_listing(image.listing, before, image.data_section_size)
+        self.place_data_labels(image, labels, stream)
+        directive.emit(image, values)
+
+    def place_data_labels(self, image, labels, stream):
+        for label in labels:
+            image.add_label(label, MEM_DATA_START + image.data_section_size)
+            if stream is not None:
+                stream.define(label)
+        labels.clear()
+
+    def encode_blocks(self, image, blocks):
+        symbols = image.symbols
+        prev_symbols = self.prev_symbols
+        # labels that moved or went away since the last run
+        moved = {s.name for s in symbols if prev_symbols.get(s.name) != s.address}
+        moved.update(label for label in prev_symbols if label not in symbols)
+
+        reused = 0
+        for block in blocks:
+            prev = block.prev
+            if prev is None:
+                self.encode_block(block, symbols)
+            else:
+                self.reuse_block(block, prev, moved, symbols)
+                reused += 1
+            image.text_seg.extend(block.words)
+
+        # the previous run's blocks go, only this run's are kept
+        for block in blocks:
+            block.prev = None
+        self.prev_blocks = {block.lines[0]: block for block in blocks}
+        self.prev_symbols = {s.name: s.address for s in symbols}
+        if DEBUG:
+            log(1, "incremental: %d/%d blocks reused", reused, len(blocks))
+
+    def encode_block(self, block, symbols):
+        block.words = array('I')
+        block.refs = []
+        block.ref_labels = set()
+        emit_text = block.words.append
+        recorder = ref_recorder_t(symbols)
+        for i, entry in enumerate(block.entries):
+            self.encode_text(emit_text, recorder, entry)
+            if recorder.refs:
+                block.refs.append((i, tuple(recorder.refs)))
+                block.ref_labels.update(recorder.refs)
+                recorder.refs = []
+
+    # take over the words of an unchanged block, encoding again only the
+    # instructions that use a label if the block or the label moved
+    def reuse_block(self, block, prev, moved, symbols):
+        block.words = prev.words
+        block.refs = prev.refs
+        block.ref_labels = prev.ref_labels
+        if block.start == prev.start:
+            if moved.isdisjoint(prev.ref_labels):
+                return
+            refs = [(i, labels) for i, labels in prev.refs
+                    if not moved.isdisjoint(labels)]
+        else:
+            refs = prev.refs
+        block.words = array('I', prev.words)
+        for i, _ in refs:
+            words = array('I')
+            self.encode_text(words.append, symbols, block.entry(i))
+            block.words[i] = words[0]
+
+    def encode_text(self, emit_text, symbols, entry):
+        emit_text(encode_ir(entry, symbols))
+
+    def encode_parallel(self, image, text_ir):
+        symbols = {s.name: s.address for s in image.symbols}
+        bounds = [(i, min(i + PARALLEL_CHUNK_WORDS, len(text_ir)))
+                  for i in range(0, len(text_ir), PARALLEL_CHUNK_WORDS)]
+        # unset means the platform default, the first of all methods
+        method = (multiprocessing.get_start_method(allow_none=True)
+                  or multiprocessing.get_all_start_methods()[0])
+        if method == 'fork':
+            # forked workers get the initargs without pickling, so
+            # text_ir goes along once and only bounds are sent
+            initargs = (symbols, verbosity, text_ir)
+            chunks = bounds
+        else:
+            initargs = (symbols, verbosity, None)
+            chunks = (text_ir[start:end] for start, end in bounds)
+        # a named context leaves the process-wide default unset
+        context = multiprocessing.get_context(method)
+        with context.Pool(self.jobs, initializer=init_encode_worker,
+                          initargs=initargs) as pool:
+            # imap hands the chunks back in the order they went out
+            for words, lookups in pool.imap(encode_chunk, chunks):
+                image.text_seg.extend(words)
+                image.symbols.lookups += lookups
+
+    def encode_relocatable(self, image, text_ir):
+        symbols = image.symbols
+        externs = extern_table_t(symbols)
+        relocs = image.relocs = []
+        emit_text = image.text_seg.append
+        text_end = MEM_TEXT_START + image.text_section_size
+        for entry in text_ir:
+            address, name, operands, _ = entry
+            emit_text(encode_ir(entry, externs))
+            for kind, label in operands:
+                if kind not in LABEL_OPERANDS:
+                    continue
+                rtype = reloc_type(name, kind)
+                if label not in symbols:
+                    relocs.append((address - MEM_TEXT_START, rtype, label, 0))
+                    continue
+                # branches to a label of this file move with it
+                if rtype == R_PC16:
+                    continue
+                target = symbols.convert_label(label)
+                if MEM_TEXT_START <= target <= text_end:
+                    relocs.append((address - MEM_TEXT_START, rtype, '.text',
+                                   target - MEM_TEXT_START))
+                else:
+                    relocs.append((address - MEM_TEXT_START, rtype, '.data',
+                                   target - MEM_DATA_START))
+
+
+################################################
+# Parallel Encoding
+#
+# Once the first pass has sized everything, the
+# text instructions are independent of each
+# other. encode_parallel cuts them into chunks of
+# PARALLEL_CHUNK_WORDS for a process pool; every
+# worker gets the symbol table once, through the
+# pool initializer, and sends back the chunk's
+# words as an array('I').
+################################################
+
+# symbol table and (forked workers only) text_ir of an encode
+# worker process, set by init_encode_worker. Never set in the
+# assembling process itself
+worker_symbols = None
+worker_text_ir = None
+
+
+def init_encode_worker(symbols, level, text_ir):
+    global worker_symbols, worker_text_ir
+    set_verbosity(level)
+    worker_text_ir = text_ir
+    worker_symbols = symbol_table_t()
+    for name, address in symbols.items():
+        symbol = symbol_t()
+        symbol.name = name
+        symbol.address = address
+        worker_symbols.symbols[name] = symbol
+
+
+# (words, symbol lookups) of one chunk of text_ir, given as the
+# entries or as (start, end) into worker_text_ir
+def encode_chunk(chunk):
+    if type(chunk) is tuple:
+        start, end = chunk
+        chunk = worker_text_ir[start:end]
+    symbols = worker_symbols
+    symbols.lookups = 0
+    words = array('I', [encode_ir(entry, symbols) & 0xffffffff for entry in chunk])
+    return words, symbols.lookups
+
+
+# in-process entry point for simulators: no files, no '0'/'1' strings
+def assemble_to_memory(source):
+    return Assembler().assemble_to_memory(source)
 
 #################################################
 # # # # # # # # # # # # # # # # # # # # # # # # #
@@ -438,44 +2396,47 @@ def make_binary_file(fout):
 ################################################
 
 
-if __name__ == '__main__':
-    argc = len(sys.argv)
-    log(1, f"Arguments count: {argc}")
-
-    if argc != 2:
-        log(3, f"Usage   : {sys.argv[0]} <*.s>")
-        log(3, f"Example : {sys.argv[0]} sample_input/example.s")
-        exit(1)
+def assemble_single(input_filename, format='text', cache=None, profile=None,
+                    profile_json=None, output_filename=None, reports=None,
+                    encode_jobs=None):
+    # '-' reads the source from stdin in one streaming pass and writes
+    # the object to stdout unless output_filename says otherwise
+    if input_filename == '-':
+        return assemble_piped(format, profile, profile_json,
+                              output_filename or '-', reports)
 
-    input_filename = sys.argv[1]
     input_filePath = os.path.join(os.curdir, input_filename)
 
     if os.path.exists(input_filePath) == False:
         log(3,
             f"No input file {input_filename} exists. Please check the file name and path.")
-        exit(1)
+        return 1
 
     f_in = open(input_filePath, 'r')
 
     if f_in == None:
         log(3,
             f"Input file {input_filename} is not opened. Please check the file")
-        exit(1)
-
-    output_filename = change_file_ext(sys.argv[1])
-    output_filePath = os.path.join(os.curdir, output_filename)
+        return 1
 
-    if os.path.exists(output_filePath) == True:
-        log(0, f"Output file {output_filename} exists. Remake the file")
-        os.remove(output_filePath)
+    if output_filename is None:
+        output_filename = change_file_ext(input_filename)
+    if output_filename == '-':
+        output_filePath = '-'
     else:
-        log(0, f"Output file {output_filename} does not exist. Make the file")
+        output_filePath = os.path.join(os.curdir, output_filename)
 
-    f_out = open(output_filePath, 'w')
+        if os.path.exists(output_filePath) == True:
+            log(0, f"Output file {output_filename} exists. Remake the file")
+            os.remove(output_filePath)
+        else:
+            log(0, f"Output file {output_filename} does not exist. Make the file")
+
+    f_out = open_output(output_filePath, format)
     if f_out == None:
         log(3,
             f"Output file {output_filename} is not opened. Please check the file")
-        exit(1)
+        return 1
 
     ################################################
     # Let's compelte the below functions!
@@ -484,8 +2445,462 @@ if __name__ == '__main__':
     #   make_binary_file(output)
     ################################################
 
-    make_symbol_table(f_in)
-    make_binary_file(f_out)
+    if profile is not None:
+        profile.start_memory()
+    try:
+        # a cached image has no listing entries or relocations, so
+        # listings and relocatable objects bypass the cache
+        listing = bool(reports) and 'listing' in reports
+        if listing or format == 'rel':
+            cache = None
+        assembler = Assembler(cache=cache, profile=profile, listing=listing,
+                              relocatable=format == 'rel', jobs=encode_jobs)
+        if cache is not None:
+            image = assembler.assemble_file(input_filePath)
+        else:
+            image = assembler.assemble(f_in)
+        image.write_object(f_out, format)
+        write_reports(image, reports)
+        image.close()
+    except asm_error as e:
+        log(3, str(e))
+        return 1
+    finally:
+        f_in.close()
+        close_output(f_out)
+        if profile is not None:
+            profile.stop_memory()
+
+    if cache is not None:
+        cache.report()
+
+    if profile is not None:
+        write_profile(profile, profile_json)
+
+    return 0
+
+
+def assemble_piped(format='text', profile=None, profile_json=None,
+                   output_filename='-', reports=None):
+    f_out = open_output(output_filename, format)
+
+    if profile is not None:
+        profile.start_memory()
+    try:
+        listing = bool(reports) and 'listing' in reports
+        assembler = Assembler(profile=profile, listing=listing,
+                              relocatable=format == 'rel')
+        image = assembler.assemble_stream(sys.stdin)
+        image.write_object(f_out, format)
+        write_reports(image, reports)
+        image.close()
+    except asm_error as e:
+        log(3, str(e))
+        return 1
+    finally:
+        close_output(f_out)
+        if profile is not None:
+            profile.stop_memory()
+
+    if profile is not None:
+        write_profile(profile, profile_json)
+
+    return 0
+
+
+# every object in paths as annotated assembly, one after another
+def disassemble_files(paths, output_filename='-'):
+    f_out = open_output(output_filename, 'text')
+    try:
+        for path in paths:
+            image = load_object(path)
+            try:
+                if len(paths) > 1:
+                    f_out.write(f"# {path}\n")
+                f_out.write('\n'.join(disassemble_image(image)))
+                f_out.write('\n')
+            finally:
+                image.close()
+    except BrokenPipeError:
+        raise
+    except (OSError, asm_error) as e:
+        log(3, f"{path}: {e}")
+        return 1
+    finally:
+        close_output(f_out)
+    return 0
+
+
+# reports maps 'listing', 'symbol_map' or 'symbol_map_json' to the
+# path ('-' for stdout) ObjectImage.write_<name> writes to
+def write_reports(image, reports):
+    for name, path in (reports or {}).items():
+        fout = open_output(path, 'text')
+        try:
+            getattr(image, 'write_' + name)(fout)
+        finally:
+            close_output(fout)
+
+
+def write_profile(profile, profile_json=None):
+    if profile_json is None:
+        profile.report()
+    elif profile_json == '-':
+        print(json.dumps(profile.to_dict(), indent=2))
+    else:
+        with open(profile_json, 'w') as f:
+            json.dump(profile.to_dict(), f, indent=2)
 
-    f_in.close()
-    f_out.close()
+
+################################################
+# Batch mode
+#
+# Many sources are assembled on a process pool,
+# each .o is written next to its .s exactly like
+# the single-file mode does.
+################################################
+
+def expand_inputs(patterns):
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths.extend(sorted(glob.glob(os.path.join(pattern, '*.s'))))
+        elif glob.has_magic(pattern):
+            paths.extend(sorted(glob.glob(pattern, recursive=True)))
+        else:
+            paths.append(pattern)
+    return paths
+
+
+# returns (path, words, seconds, error, cache hits, cache misses).
+# The cache is not evicted per file, assemble_batch does it once
+def batch_worker(path, format='text', cache_dir=None):
+    t0 = time.perf_counter()
+    cache = None
+    try:
+        if cache_dir is not None and format != 'rel':
+            cache = assembly_cache_t(cache_dir, None)
+        image = Assembler(cache=cache, relocatable=format == 'rel').assemble_file(path)
+        with open(change_file_ext(path), output_mode(format)) as f_out:
+            image.write_object(f_out, format)
+        image.close()
+    except (asm_error, OSError) as e:
+        return path, 0, time.perf_counter() - t0, str(e), 0, 0
+    words = len(image.text_seg) + len(image.data_seg)
+    hits = cache.hits if cache is not None else 0
+    misses = cache.misses if cache is not None else 0
+    return path, words, time.perf_counter() - t0, None, hits, misses
+
+
+def assemble_batch(paths, jobs=None, format='text', cache_dir=None,
+                   cache_size=CACHE_MAX_BYTES):
+    t0 = time.perf_counter()
+    failed = 0
+    total_words = 0
+    busy = 0.0
+    cache_hits = 0
+    cache_misses = 0
+
+    worker = functools.partial(batch_worker, format=format, cache_dir=cache_dir)
+    if jobs == 1:
+        results = map(worker, paths)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(jobs, initializer=set_verbosity,
+                                    initargs=(verbosity,))
+        results = pool.imap_unordered(worker, paths, chunksize=4)
+
+    try:
+        for path, words, seconds, err, hits, misses in results:
+            busy += seconds
+            cache_hits += hits
+            cache_misses += misses
+            if err is not None:
+                failed += 1
+                log(3, f"{path}: {err}")
+                continue
+            total_words += words
+            log(1, "%s: %d words in %.3fs", path, words, seconds)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    elapsed = time.perf_counter() - t0
+    n = len(paths)
+    log(2, f"{n - failed}/{n} files, {total_words} words in {elapsed:.3f}s "
+           f"({n / elapsed:.1f} files/s, {total_words / elapsed:,.0f} words/s, "
+           f"{busy:.3f}s worker time)")
+    if cache_dir is not None:
+        cache = assembly_cache_t(cache_dir, cache_size)
+        cache.evict()
+        log(1, "cache: %d hits, %d misses, %d evictions", cache_hits,
+            cache_misses, cache.evictions, level=LOG_ALWAYS)
+    return 1 if failed else 0
+
+
+################################################
+# Verify mode
+#
+# Every source is assembled, disassembled and
+# assembled again, the two images have to be
+# bit-identical. If a reference object (.o or
+# .ans) is found the image is compared with it
+# too. Mismatches are reported word by word
+# with the decoded fields of both sides.
+################################################
+
+def section_words(seg):
+    words = array('I')
+    for chunk in seg.chunks():
+        words.extend(chunk)
+    return words
+
+
+def format_fields(word, address):
+    op = word >> 26
+    fields = "op=%d rs=%d rt=%d" % (op, word >> 21 & 0x1f, word >> 16 & 0x1f)
+    if op == 0:
+        fields += " rd=%d shamt=%d funct=%d" % (word >> 11 & 0x1f,
+                                                word >> 6 & 0x1f, word & 0x3f)
+    elif op == 2 or op == 3:
+        fields = "op=%d target=0x%07x" % (op, word & 0x3ffffff)
+    else:
+        fields += " imm=0x%04x" % (word & 0xffff)
+    decoded = decode_word(word, address)
+    text = "%s %s" % decoded if decoded is not None else "?"
+    return "0x%08x %s [%s]" % (word, text, fields)
+
+
+# lines describing the first limit differences of two images
+def compare_images(expected, got, limit=10):
+    problems = []
+    if expected.text_section_size != got.text_section_size:
+        problems.append("text size: expected %d, got %d"
+                        % (expected.text_section_size, got.text_section_size))
+    if expected.data_section_size != got.data_section_size:
+        problems.append("data size: expected %d, got %d"
+                        % (expected.data_section_size, got.data_section_size))
+    for name, start, want, have in (
+            ('text', MEM_TEXT_START, section_words(expected.text_seg),
+             section_words(got.text_seg)),
+            ('data', MEM_DATA_START, section_words(expected.data_seg),
+             section_words(got.data_seg))):
+        if want == have:
+            continue
+        shown = 0
+        for i in range(max(len(want), len(have))):
+            w = want[i] if i < len(want) else None
+            h = have[i] if i < len(have) else None
+            if w == h:
+                continue
+            if shown == limit:
+                problems.append(f"{name}: more mismatches not shown")
+                break
+            address = start + i * BYTES_PER_WORD
+            problems.append("%s 0x%08x: expected %s" % (
+                name, address, "nothing" if w is None else format_fields(w, address)))
+            problems.append("%s            got %s" % (
+                ' ' * len(name), "nothing" if h is None else format_fields(h, address)))
+            shown += 1
+    return problems
+
+
+# <stem>.o or <stem>.ans in ref_dir, else <stem>.ans next to the source
+def find_reference(path, ref_dir=None):
+    stem = os.path.splitext(path)[0]
+    candidates = []
+    if ref_dir is not None:
+        name = os.path.basename(stem)
+        candidates = [os.path.join(ref_dir, name + ext) for ext in ('.o', '.ans')]
+    candidates.append(stem + '.ans')
+    for candidate in candidates:
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+# returns (path, words, seconds, problems, reference used)
+def verify_worker(path, ref_dir=None, limit=10):
+    t0 = time.perf_counter()
+    problems = []
+    reference = None
+    try:
+        image = Assembler().assemble_file(path)
+        source = '\n'.join(disassemble_image(image))
+        again = Assembler().assemble(source)
+        problems = ["round trip: " + p for p in compare_images(image, again, limit)]
+        again.close()
+
+        reference = find_reference(path, ref_dir)
+        if reference is not None:
+            ref_image = load_object(reference)
+            problems += [os.path.basename(reference) + ": " + p
+                         for p in compare_images(ref_image, image, limit)]
+            ref_image.close()
+        words = len(image.text_seg) + len(image.data_seg)
+        image.close()
+    except (asm_error, OSError) as e:
+        return path, 0, time.perf_counter() - t0, [str(e)], reference
+    return path, words, time.perf_counter() - t0, problems, reference
+
+
+def verify_batch(paths, jobs=None, ref_dir=None, limit=10):
+    t0 = time.perf_counter()
+    failed = 0
+    compared = 0
+    total_words = 0
+
+    worker = functools.partial(verify_worker, ref_dir=ref_dir, limit=limit)
+    if jobs == 1 or len(paths) == 1:
+        results = map(worker, paths)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(jobs, initializer=set_verbosity,
+                                    initargs=(verbosity,))
+        results = pool.imap_unordered(worker, paths, chunksize=4)
+
+    try:
+        for path, words, seconds, problems, reference in results:
+            total_words += words
+            if reference is not None:
+                compared += 1
+            if problems:
+                failed += 1
+                log(3, f"{path}: FAIL")
+                for problem in problems:
+                    log(1, "  %s", problem, level=LOG_ALWAYS)
+                continue
+            log(1, "%s: ok (%d words%s) in %.3fs", path, words,
+                f", matches {reference}" if reference else "", seconds)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    elapsed = time.perf_counter() - t0
+    n = len(paths)
+    log(2, f"verified {n - failed}/{n} files ({compared} against a reference), "
+           f"{total_words} words in {elapsed:.3f}s")
+    return 1 if failed else 0
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0])
+    parser.add_argument('inputs', nargs='*', metavar='<*.s>',
+                        help="source files, directories or glob patterns")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="worker processes for batch mode "
+                             "(default: one per CPU)")
+    parser.add_argument('-J', '--encode-jobs', type=int, default=None,
+                        metavar='N',
+                        help="encode the text section of a single large "
+                             "file on N worker processes")
+    parser.add_argument('-f', '--format', choices=OUTPUT_FORMATS,
+                        default='text',
+                        help="object format: '0'/'1' text lines (default), "
+                             "packed big-endian binary, or relocatable "
+                             "for linker.py")
+    parser.add_argument('--cache-dir', default=None,
+                        help="reuse finished images from this directory "
+                             "for unchanged sources")
+    parser.add_argument('--cache-size', type=int,
+                        default=CACHE_MAX_BYTES >> 20, metavar='MB',
+                        help="size bound of the cache directory "
+                             "(default: %(default)s)")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="-v for progress messages, -vv for debug dumps")
+    parser.add_argument('-o', '--output', default=None, metavar='PATH',
+                        help="object file of a single-file run "
+                             "('-' for stdout, default: <input>.o)")
+    parser.add_argument('-d', '--disassemble', action='store_true',
+                        help="inputs are object files (either format), "
+                             "print them as assembly")
+    parser.add_argument('-l', '--listing', default=None, metavar='PATH',
+                        help="write a listing (line, address, word, source) "
+                             "of a single-file run to PATH ('-' for stdout)")
+    parser.add_argument('--symbol-map', default=None, metavar='PATH',
+                        help="write the symbols as sorted 'address type name' "
+                             "lines to PATH")
+    parser.add_argument('--symbol-map-json', default=None, metavar='PATH',
+                        help="write the symbols and section layout as JSON "
+                             "to PATH")
+    parser.add_argument('--verify', action='store_true',
+                        help="assemble, disassemble and reassemble every "
+                             "input and compare with its reference object")
+    parser.add_argument('--ref-dir', default=None, metavar='DIR',
+                        help="reference objects for --verify as DIR/<name>.o "
+                             "or .ans (default: <name>.ans next to the source)")
+    parser.add_argument('--max-mismatches', type=int, default=10, metavar='N',
+                        help="mismatching words shown per comparison "
+                             "(default: %(default)s)")
+    parser.add_argument('--profile', action='store_true',
+                        help="report time per phase, counters and peak "
+                             "memory of a single-file run")
+    parser.add_argument('--profile-json', default=None, metavar='PATH',
+                        help="write the profile as JSON to PATH "
+                             "('-' for stdout), implies --profile")
+    parser.add_argument('--profile-memory', action='store_true',
+                        help="also trace the peak memory with tracemalloc, "
+                             "which slows the run down; implies --profile")
+    args = parser.parse_args(argv[1:])
+
+    set_verbosity(max(args.verbose, verbosity))
+    object_output = args.output
+    if object_output is None and (args.inputs == ['-'] or args.disassemble):
+        object_output = '-'
+    to_stdout = [name for name, path in (
+                     ('the object', object_output),
+                     ('--listing', args.listing),
+                     ('--symbol-map', args.symbol_map),
+                     ('--symbol-map-json', args.symbol_map_json),
+                     ('--profile-json', args.profile_json))
+                 if path == '-']
+    if len(to_stdout) > 1:
+        log(3, f"Only one output can go to stdout ('-'), got {' and '.join(to_stdout)}")
+        return 1
+    if to_stdout:
+        global log_stream
+        log_stream = sys.stderr
+    log(1, "Arguments count: %d", len(argv))
+
+    if not args.inputs:
+        log(3, f"Usage   : {argv[0]} <*.s>")
+        log(3, f"Example : {argv[0]} sample_input/example.s")
+        log(3, f"Batch   : {argv[0]} -j 8 'sample_input/*.s'")
+        return 1
+
+    paths = expand_inputs(args.inputs)
+    if args.disassemble:
+        return disassemble_files(paths, args.output or '-')
+    if args.verify:
+        return verify_batch(paths, args.jobs, args.ref_dir, args.max_mismatches)
+    if paths == args.inputs and len(paths) == 1 and args.jobs is None:
+        cache = None
+        if args.cache_dir is not None:
+            cache = assembly_cache_t(args.cache_dir, args.cache_size << 20)
+        profile = None
+        if args.profile or args.profile_json is not None or args.profile_memory:
+            profile = profile_t(memory=args.profile_memory)
+        reports = {name: path for name, path in (
+                       ('listing', args.listing),
+                       ('symbol_map', args.symbol_map),
+                       ('symbol_map_json', args.symbol_map_json))
+                   if path is not None}
+        return assemble_single(paths[0], args.format, cache, profile,
+                               args.profile_json, args.output, reports,
+                               args.encode_jobs)
+
+    if args.output is not None:
+        log(3, "-o/--output needs a single input file")
+        return 1
+
+    if not paths:
+        log(3, f"No input files match {' '.join(args.inputs)}")
+        return 1
+    return assemble_batch(paths, args.jobs, args.format, args.cache_dir,
+                          args.cache_size << 20)
+
+
+if __name__ == '__main__':
+    exit(run_main(main, sys.argv))
@@ -0,0 +1,46 @@
+################################################
+# Microbenchmark: convert_mips_to_binary throughput
+#
+# Usage (from CSE26101_PA1):
+#   python3 bench/bench_encode.py [lines]
+#
+# Encodes a synthetic stream of R-type and
+# I-type arithmetic lines and reports the
+# number of instructions encoded per second.
+################################################
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import assembler
+
+SAMPLE_LINES = [
+    '\tadd\t$1, $2, $3',
+    '\tor\t$9, $8, $7',
+    '\tsubu\t$4, $5, $6',
+    '\tslt\t$1, $1, $0',
+    '\taddi\t$1, $1, -3',
+    '\tori\t$12, $6, 0x3f',
+    '\tslti\t$13, $7, 50',
+    '\taddiu\t$1, $1, 0xfff0',
+]
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    lines = [SAMPLE_LINES[i % len(SAMPLE_LINES)] for i in range(n)]
+
+    encode = assembler.convert_mips_to_binary
+    t0 = time.perf_counter()
+    for line in lines:
+        encode(line)
+    elapsed = time.perf_counter() - t0
+
+    print(f"{n} instructions in {elapsed:.3f}s: {n / elapsed:,.0f} inst/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+################################################
+# Scaling benchmark: whole-file assembly time
+#
+# Usage (from CSE26101_PA1):
+#   python3 bench/bench_scaling.py [lines ...]
+#
+# Generates programs of 10k / 100k / 1M lines
+# (or the given sizes), assembles each one with
+# assembler.py in a fresh interpreter and
+# reports the time per source line. A flat
+# us/line column means linear behaviour.
+################################################
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ASSEMBLER = os.path.join(BENCH_DIR, '..', 'assembler.py')
+
+BODY = [
+    '\tadd\t$1, $2, $3',
+    '\taddi\t$1, $1, -3',
+    '\tlw\t$7, 400($8)',
+    '\tsw\t$7, -4($8)',
+    '\tori\t$12, $6, 0x3f',
+    '\tbne\t$1, $2, L{next}',
+    '\tbeq\t$1, $2, L{prev}',
+    '\tsll\t$1, $1, 2',
+]
+
+
+def write_program(f, n):
+    f.write('\t.data\n')
+    f.write('data1:\t.word\t100\n')
+    f.write('data2:\t.word\t0x12345678\n')
+    f.write('\t.text\n')
+    written = 4
+    block = 0
+    while written < n:
+        f.write('L%d:\n' % block)
+        written += 1
+        for line in BODY:
+            if written >= n:
+                break
+            f.write(line.format(next=block + 1, prev=block) + '\n')
+            written += 1
+        block += 1
+    # target of the last forward branch
+    f.write('L%d:\n' % block)
+    f.write('\tjr\t$31\n')
+
+
+def main():
+    sizes = [int(n) for n in sys.argv[1:]] or [10000, 100000, 1000000]
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{'lines':>10} {'seconds':>10} {'us/line':>10}")
+        for n in sizes:
+            src = os.path.join(tmp, 'scale_%d.s' % n)
+            with open(src, 'w') as f:
+                write_program(f, n)
+
+            t0 = time.perf_counter()
+            subprocess.run([sys.executable, ASSEMBLER, src], check=True,
+                           stdout=subprocess.DEVNULL)
+            elapsed = time.perf_counter() - t0
+            print(f"{n:>10} {elapsed:>10.3f} {elapsed / n * 1e6:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+################################################
+# Benchmark suite: throughput and memory
+#
+# Usage (from CSE26101_PA1):
+#   python3 bench/bench_suite.py --save base.json
+#   python3 bench/bench_suite.py --baseline base.json
+#
+# Every scenario is a program from gen_program.py
+# with its own instruction mix. Each one is
+# assembled with assembler.py in a fresh
+# interpreter (best of --repeat runs) and the
+# lines/s and peak RSS of the child are
+# recorded. With --baseline the results are
+# compared to a saved run and the exit status
+# is 1 if a scenario got slower or bigger than
+# --threshold percent.
+################################################
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from gen_program import write_program
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ASSEMBLER = os.path.join(BENCH_DIR, '..', 'assembler.py')
+
+# name -> instruction mix, see gen_program.write_program
+SCENARIOS = {
+    'plain':   dict(branch_ratio=0.0, pseudo_ratio=0.0, label_density=0.001),
+    'labels':  dict(label_density=0.5),
+    'forward': dict(branch_ratio=0.5, forward_branches=1.0),
+    'pseudo':  dict(pseudo_ratio=0.6),
+    'data':    dict(data_words=200000),
+}
+
+
+def run_assembler(src, extra_args):
+    # (seconds, peak RSS in KiB) of one assembler run
+    t0 = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, ASSEMBLER, *extra_args, src],
+                            stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - t0
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise RuntimeError(f"assembler.py failed on {src}")
+    return elapsed, usage.ru_maxrss
+
+
+def run_suite(names, lines, repeat, extra_args):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in names:
+            src = os.path.join(tmp, name + '.s')
+            with open(src, 'w') as f:
+                write_program(f, lines, **SCENARIOS[name])
+
+            runs = [run_assembler(src, extra_args) for _ in range(repeat)]
+            seconds = min(t for t, _ in runs)
+            results[name] = {
+                'lines': lines,
+                'seconds': round(seconds, 6),
+                'lines_per_s': round(lines / seconds, 1),
+                'max_rss_kib': max(rss for _, rss in runs),
+            }
+    return results
+
+
+def compare(results, baseline, threshold):
+    # prints the change of every scenario, returns the regressed names
+    regressed = []
+    print(f"{'scenario':<10} {'lines/s':>12} {'change':>8} "
+          f"{'RSS KiB':>10} {'change':>8}")
+    for name, cur in results.items():
+        base = baseline.get(name)
+        if base is None or base['lines'] != cur['lines']:
+            print(f"{name:<10} {cur['lines_per_s']:>12.0f} {'-':>8} "
+                  f"{cur['max_rss_kib']:>10} {'-':>8}")
+            continue
+        speed = (cur['lines_per_s'] / base['lines_per_s'] - 1) * 100
+        memory = (cur['max_rss_kib'] / base['max_rss_kib'] - 1) * 100
+        mark = ''
+        if speed < -threshold or memory > threshold:
+            regressed.append(name)
+            mark = '  REGRESSION'
+        print(f"{name:<10} {cur['lines_per_s']:>12.0f} {speed:>+7.1f}% "
+              f"{cur['max_rss_kib']:>10} {memory:>+7.1f}%{mark}")
+    return regressed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0])
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help="subset of: " + ', '.join(SCENARIOS))
+    parser.add_argument('-n', '--lines', type=int, default=100000,
+                        help="text instructions per program "
+                             "(default: %(default)s)")
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help="runs per scenario, the fastest counts "
+                             "(default: %(default)s)")
+    parser.add_argument('-f', '--format', default='text',
+                        help="object format passed to assembler.py")
+    parser.add_argument('--save', metavar='PATH',
+                        help="write the results as a baseline to PATH")
+    parser.add_argument('--baseline', metavar='PATH',
+                        help="compare against a saved baseline")
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help="allowed slowdown / memory growth in percent "
+                             "(default: %(default)s)")
+    args = parser.parse_args(argv[1:])
+
+    names = args.scenarios or list(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name}")
+
+    results = run_suite(names, args.lines, args.repeat, ['-f', args.format])
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressed = compare(results, baseline, args.threshold)
+        if regressed:
+            print(f"regressed: {' '.join(regressed)}")
+            return 1
+        return 0
+
+    print(f"{'scenario':<10} {'lines':>10} {'seconds':>10} {'lines/s':>12} "
+          f"{'RSS KiB':>10}")
+    for name, r in results.items():
+        print(f"{name:<10} {r['lines']:>10} {r['seconds']:>10.3f} "
+              f"{r['lines_per_s']:>12.0f} {r['max_rss_kib']:>10}")
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main(sys.argv))
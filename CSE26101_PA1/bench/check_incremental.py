@@ -0,0 +1,156 @@
+################################################
+# Incremental mode check against a full rebuild
+#
+# Usage (from CSE26101_PA1):
+#   python3 bench/check_incremental.py
+#   python3 bench/check_incremental.py -n 20000 --edits 200 --seed 7
+#
+# Generates a program with gen_program.py and
+# applies a series of edits to it: a fixed set
+# (change, insert and delete an instruction,
+# add and rename a label, grow .data, revert)
+# followed by --edits random ones. After every
+# edit the source is assembled by one long-lived
+# Assembler(incremental=True) and by a fresh
+# Assembler(); text, data and symbols have to
+# match, or both have to fail with the same
+# error. The exit status is 1 on a mismatch.
+################################################
+
+import argparse
+import io
+import os
+import random
+import re
+import sys
+import time
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from assembler import Assembler, asm_error
+from gen_program import add_mix_arguments, mix_of, write_program
+
+
+def build(asm, lines):
+    # (text words, data words, symbols) or the error message
+    try:
+        image = asm.assemble(lines)
+    except asm_error as e:
+        return str(e)
+    try:
+        return (array('I', image.text_seg), array('I', image.data_seg),
+                sorted((s.name, s.address) for s in image.symbols))
+    finally:
+        image.close()
+
+
+# indices of the text instructions, where the edits happen
+def instruction_lines(lines):
+    start = lines.index('\t.text') + 1
+    return [i for i in range(start, len(lines) - 1) if lines[i].startswith('\t')]
+
+
+def change_instruction(lines, rng):
+    i = rng.choice(instruction_lines(lines))
+    lines[i] = '\taddi\t$%d, $%d, %d' % (rng.randrange(1, 26), rng.randrange(32),
+                                          rng.randrange(-0x8000, 0x8000))
+    return 'change line %d' % (i + 1)
+
+
+def insert_instruction(lines, rng):
+    insts = instruction_lines(lines)
+    i = rng.choice(insts)
+    lines.insert(i, lines[rng.choice(insts)])
+    return 'insert at line %d' % (i + 1)
+
+
+def delete_instruction(lines, rng):
+    i = rng.choice(instruction_lines(lines))
+    del lines[i]
+    return 'delete line %d' % (i + 1)
+
+
+def add_label(lines, rng):
+    insts = instruction_lines(lines)
+    i = rng.choice(insts)
+    label = 'E%d' % len(lines)
+    lines.insert(i, label + ':')
+    lines.insert(rng.choice(insts[:insts.index(i) + 1]),
+                 '\tbeq\t$1, $2, ' + label)
+    return 'add label %s' % label
+
+
+def rename_label(lines, rng):
+    labels = [line[:-1] for line in lines if re.fullmatch(r'L\d+:', line)]
+    if not labels:
+        return add_label(lines, rng)
+    old = rng.choice(labels)
+    pattern = re.compile(r'\b%s\b' % old)
+    lines[:] = [pattern.sub('R' + old, line) for line in lines]
+    return 'rename %s' % old
+
+
+def grow_data(lines, rng):
+    # moves every data label after the first, so every la changes
+    i = lines.index('\t.data') + 1
+    lines.insert(i + 1, '\t.word\t%d' % rng.randrange(-0x8000, 0x8000))
+    return 'grow .data'
+
+
+EDITS = [change_instruction, insert_instruction, delete_instruction,
+         add_label, rename_label, grow_data]
+
+
+def edit_steps(lines, edits, seed):
+    # (description, lines) after every edit
+    rng = random.Random(seed)
+    original = list(lines)
+    for edit in EDITS:
+        yield edit(lines, rng), lines
+    yield 'revert', original
+    lines = list(original)
+    for _ in range(edits):
+        yield rng.choice(EDITS)(lines, rng), lines
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0])
+    parser.add_argument('-n', '--lines', type=int, default=5000,
+                        help="text instructions (default: %(default)s)")
+    parser.add_argument('--edits', type=int, default=50,
+                        help="random edits after the fixed ones "
+                             "(default: %(default)s)")
+    add_mix_arguments(parser)
+    args = parser.parse_args(argv[1:])
+
+    f = io.StringIO()
+    write_program(f, args.lines, **mix_of(args))
+    lines = f.getvalue().splitlines()
+
+    incremental = Assembler(incremental=True)
+    build(incremental, lines)
+    failed = 0
+    t_incremental = t_full = 0.0
+    for step, (what, source) in enumerate(edit_steps(lines, args.edits, args.seed), 1):
+        t0 = time.perf_counter()
+        got = build(incremental, source)
+        t1 = time.perf_counter()
+        want = build(Assembler(), source)
+        t2 = time.perf_counter()
+        t_incremental += t1 - t0
+        t_full += t2 - t1
+        if got != want:
+            failed += 1
+            print(f"step {step} ({what}): incremental build differs from a full rebuild")
+            if isinstance(got, str) or isinstance(want, str):
+                print(f"  incremental: {got if isinstance(got, str) else 'ok'}")
+                print(f"  full:        {want if isinstance(want, str) else 'ok'}")
+
+    print(f"{step} edits, {failed} mismatches; incremental {t_incremental:.3f}s, "
+          f"full rebuild {t_full:.3f}s")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    exit(main(sys.argv))
@@ -0,0 +1,186 @@
+################################################
+# Synthetic MIPS program generator
+#
+# Usage (from CSE26101_PA1):
+#   python3 bench/gen_program.py -n 100000 -o big.s
+#   python3 bench/gen_program.py -n 1000 --pseudo-ratio 0.5 > mix.s
+#
+# Writes a valid program for assembler.py with
+# the given number of text instructions and
+# instruction mix:
+#   --label-density     labels per instruction
+#   --branch-ratio      share of branches / jumps
+#   --forward-branches  share of those that jump
+#                       to a later label
+#   --pseudo-ratio      share of pseudo-ops
+#   --data-words        size of the .data section
+# The same seed always gives the same program.
+################################################
+
+import argparse
+import random
+import sys
+
+# a label is forced at least this often so every branch
+# offset stays inside its 16 bit field
+MAX_LABEL_GAP = 4096
+DATA_LABEL_GAP = 16
+
+PLAIN = [
+    '\tadd\t${d}, ${s}, ${t}',
+    '\taddu\t${d}, ${s}, ${t}',
+    '\tsub\t${d}, ${s}, ${t}',
+    '\tand\t${d}, ${s}, ${t}',
+    '\tor\t${d}, ${s}, ${t}',
+    '\tnor\t${d}, ${s}, ${t}',
+    '\tslt\t${d}, ${s}, ${t}',
+    '\taddi\t${d}, ${s}, {imm}',
+    '\tandi\t${d}, ${s}, {uimm}',
+    '\tori\t${d}, ${s}, 0x{uimm:x}',
+    '\tslti\t${d}, ${s}, {imm}',
+    '\tlui\t${d}, {uimm}',
+    '\tsll\t${d}, ${s}, {shamt}',
+    '\tsrl\t${d}, ${s}, {shamt}',
+    '\tlw\t${d}, {offset}(${s})',
+    '\tsw\t${d}, {offset}(${s})',
+]
+
+PSEUDO = [
+    '\tla\t${d}, {data}',
+    '\tli\t${d}, {imm}',
+    '\tli\t${d}, 0x{wide:x}',
+    '\tmove\t${d}, ${s}',
+    '\tnop',
+    '\tpush\t${d}',
+    '\tpop\t${d}',
+]
+
+BRANCHES = [
+    '\tbeq\t${s}, ${t}, {target}',
+    '\tbne\t${s}, ${t}, {target}',
+    '\tj\t{target}',
+    '\tjal\t{target}',
+]
+
+PSEUDO_BRANCHES = [
+    '\tblt\t${s}, ${t}, {target}',
+    '\tbgt\t${s}, ${t}, {target}',
+    '\tble\t${s}, ${t}, {target}',
+    '\tbge\t${s}, ${t}, {target}',
+]
+
+
+def label_positions(rng, lines, label_density):
+    # index of the instruction each text label is placed before
+    positions = [0]
+    for i in range(1, lines):
+        if rng.random() < label_density or i - positions[-1] >= MAX_LABEL_GAP:
+            positions.append(i)
+    return positions
+
+
+def write_data(f, rng, data_words):
+    f.write('\t.data\n')
+    labels = []
+    for i in range(0, data_words, DATA_LABEL_GAP):
+        label = 'data%d' % len(labels)
+        labels.append(label)
+        words = ', '.join(str(rng.randrange(-0x8000, 0x8000))
+                          for _ in range(min(DATA_LABEL_GAP, data_words - i)))
+        f.write('%s:\t.word\t%s\n' % (label, words))
+    return labels
+
+
+def write_program(f, lines, label_density=0.05, branch_ratio=0.15,
+                  forward_branches=0.5, pseudo_ratio=0.1, data_words=64,
+                  seed=0):
+    rng = random.Random(seed)
+    data_labels = write_data(f, rng, max(data_words, 1))
+    positions = label_positions(rng, lines, label_density)
+
+    f.write('\t.text\n')
+    # current label is positions[block], the next one
+    # positions[block + 1]; the program ends with label L<len>
+    block = -1
+    next_label = 0
+    for i in range(lines):
+        if next_label < len(positions) and positions[next_label] == i:
+            block = next_label
+            next_label += 1
+            f.write('L%d:\n' % block)
+
+        fields = {
+            'd': rng.randrange(1, 26),
+            's': rng.randrange(0, 32),
+            't': rng.randrange(0, 32),
+            'imm': rng.randrange(-0x8000, 0x8000),
+            'uimm': rng.randrange(0, 0x10000),
+            'wide': rng.randrange(0x10000, 0x100000000),
+            'shamt': rng.randrange(0, 32),
+            'offset': rng.randrange(-0x8000, 0x8000, 4),
+            'data': rng.choice(data_labels),
+        }
+        roll = rng.random()
+        if roll < branch_ratio:
+            if rng.random() < forward_branches:
+                fields['target'] = 'L%d' % (block + 1)
+            else:
+                fields['target'] = 'L%d' % block
+            if rng.random() < pseudo_ratio:
+                template = rng.choice(PSEUDO_BRANCHES)
+            else:
+                template = rng.choice(BRANCHES)
+        elif roll < branch_ratio + pseudo_ratio * (1 - branch_ratio):
+            template = rng.choice(PSEUDO)
+        else:
+            template = rng.choice(PLAIN)
+        f.write(template.format(**fields) + '\n')
+
+    # target of the last forward branches
+    f.write('L%d:\n' % len(positions))
+    f.write('\tjr\t$31\n')
+
+
+def add_mix_arguments(parser):
+    parser.add_argument('--label-density', type=float, default=0.05,
+                        help="labels per instruction (default: %(default)s)")
+    parser.add_argument('--branch-ratio', type=float, default=0.15,
+                        help="share of branches and jumps (default: %(default)s)")
+    parser.add_argument('--forward-branches', type=float, default=0.5,
+                        help="share of branches to a later label "
+                             "(default: %(default)s)")
+    parser.add_argument('--pseudo-ratio', type=float, default=0.1,
+                        help="share of pseudo-ops (default: %(default)s)")
+    parser.add_argument('--data-words', type=int, default=64,
+                        help=".data section size in words (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def mix_of(args):
+    return dict(label_density=args.label_density,
+                branch_ratio=args.branch_ratio,
+                forward_branches=args.forward_branches,
+                pseudo_ratio=args.pseudo_ratio,
+                data_words=args.data_words,
+                seed=args.seed)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0])
+    parser.add_argument('-n', '--lines', type=int, default=10000,
+                        help="text instructions (default: %(default)s)")
+    parser.add_argument('-o', '--output', default='-',
+                        help="output file ('-' for stdout)")
+    add_mix_arguments(parser)
+    args = parser.parse_args(argv[1:])
+
+    if args.output == '-':
+        write_program(sys.stdout, args.lines, **mix_of(args))
+    else:
+        with open(args.output, 'w') as f:
+            write_program(f, args.lines, **mix_of(args))
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main(sys.argv))
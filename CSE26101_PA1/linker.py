@@ -0,0 +1,150 @@
+import sys
+import argparse
+import time
+
+import assembler
+from assembler import (MEM_TEXT_START, MEM_DATA_START, BYTES_PER_WORD,
+                       SECTION_SPILL_WORDS, ObjectImage, asm_error, log,
+                       set_verbosity, verbosity, load_object, apply_reloc,
+                       open_output, close_output, section_words, run_main)
+
+################################################
+# Linker
+#
+# Usage:
+#   python3 assembler.py -f rel a.s b.s
+#   python3 linker.py -o prog.o a.o b.o
+#
+# Merges relocatable objects (assembler.py -f rel)
+# into one object of the usual formats. The text
+# sections are placed one after another from
+# MEM_TEXT_START in command line order, the data
+# sections from MEM_DATA_START. Then every module
+# is copied once with its relocations patched.
+################################################
+
+
+class module_t:
+    def __init__(self, path, image, text_base, data_base):
+        self.path = path
+        self.image = image
+        self.text_base = text_base
+        self.data_base = data_base
+
+    # final address of a symbol of this module, given at the addresses
+    # the assembler used
+    def relocate(self, address):
+        if address >= MEM_DATA_START:
+            return self.data_base + address - MEM_DATA_START
+        return self.text_base + address - MEM_TEXT_START
+
+
+def load_modules(paths):
+    modules = []
+    text_base = MEM_TEXT_START
+    data_base = MEM_DATA_START
+    for path in paths:
+        image = load_object(path)
+        if image.relocs is None:
+            image.close()
+            raise asm_error(f"{path}: not a relocatable object (assemble with -f rel)")
+        modules.append(module_t(path, image, text_base, data_base))
+        text_base += image.text_section_size
+        data_base += image.data_section_size
+    return modules
+
+
+# global name -> final address
+def global_symbols(modules):
+    symbols = {}
+    owner = {}
+    for module in modules:
+        for symbol in module.image.symbols:
+            if symbol.name in symbols:
+                raise asm_error(f"Duplicate symbol {symbol.name} in {module.path} "
+                                f"(already defined in {owner[symbol.name]})")
+            symbols[symbol.name] = module.relocate(symbol.address)
+            owner[symbol.name] = module.path
+    return symbols
+
+
+def link(paths, spill_words=SECTION_SPILL_WORDS):
+    modules = load_modules(paths)
+    try:
+        symbols = global_symbols(modules)
+        out = ObjectImage(spill_words)
+        for module in modules:
+            image = module.image
+            words = section_words(image.text_seg)
+            for offset, rtype, name, addend in image.relocs:
+                if name == '.text':
+                    value = module.text_base + addend
+                elif name == '.data':
+                    value = module.data_base + addend
+                elif name in symbols:
+                    value = symbols[name] + addend
+                else:
+                    raise asm_error(f"{module.path}: undefined symbol {name}")
+                index = offset // BYTES_PER_WORD
+                try:
+                    words[index] = apply_reloc(words[index], rtype, value,
+                                               module.text_base + offset)
+                except asm_error as e:
+                    raise asm_error(f"{module.path}: {e}") from None
+            out.text_seg.extend(words)
+            for chunk in image.data_seg.chunks():
+                out.data_seg.extend(chunk)
+            out.text_section_size += image.text_section_size
+            out.data_section_size += image.data_section_size
+
+        for name, address in symbols.items():
+            out.add_label(name, address)
+        return out
+    finally:
+        for module in modules:
+            module.image.close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog=argv[0])
+    parser.add_argument('objects', nargs='+', metavar='<*.o>',
+                        help="relocatable objects, in link order")
+    parser.add_argument('-o', '--output', default='a.o', metavar='PATH',
+                        help="linked object ('-' for stdout, "
+                             "default: %(default)s)")
+    parser.add_argument('-f', '--format', choices=('text', 'bin'),
+                        default='text',
+                        help="format of the linked object (default: text)")
+    parser.add_argument('--symbol-map', default=None, metavar='PATH',
+                        help="write the global symbols as sorted "
+                             "'address type name' lines to PATH")
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    args = parser.parse_args(argv[1:])
+
+    set_verbosity(max(args.verbose, verbosity))
+    if args.output == '-':
+        assembler.log_stream = sys.stderr
+
+    t0 = time.perf_counter()
+    try:
+        image = link(args.objects)
+    except (asm_error, OSError) as e:
+        log(3, str(e))
+        return 1
+
+    fout = open_output(args.output, args.format)
+    try:
+        image.write_object(fout, args.format)
+    finally:
+        close_output(fout)
+    if args.symbol_map is not None:
+        with open(args.symbol_map, 'w') as f:
+            image.write_symbol_map(f)
+    log(1, "%d objects, %d text and %d data words in %.3fs", len(args.objects),
+        len(image.text_seg), len(image.data_seg), time.perf_counter() - t0)
+    image.close()
+    return 0
+
+
+if __name__ == '__main__':
+    exit(run_main(main, sys.argv))